@@ -1,8 +1,12 @@
 __version__ = '0.1.26'
 
+from .base import ConflictError
+from .cache import ReadCache
 from .control import AsyncControl, SyncControl
+from .events import AsyncEventConsumer, JobEvent, SyncEventConsumer
 from .job import AsyncJob, SyncJob
 from .notice import AsyncNotice, SyncNotice
+from .session import AsyncSession, SyncSession
 
 __all__ = [
     'AsyncControl',
@@ -11,4 +15,11 @@ __all__ = [
     'SyncJob',
     'AsyncNotice',
     'SyncNotice',
+    'ReadCache',
+    'AsyncEventConsumer',
+    'SyncEventConsumer',
+    'JobEvent',
+    'AsyncSession',
+    'SyncSession',
+    'ConflictError',
 ]
@@ -2,21 +2,71 @@
 from __future__ import annotations
 from datetime import datetime
 import json
-from typing import Any, Type, TypeVar, Union
+from typing import Any, Callable, Iterable, Optional, Type, TypeVar, Union
 
 from redis import Redis as SyncRedis
 from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import WatchError
+
+from .cache import ReadCache
+from .scripts import LuaScript, async_execute, execute
+from .utils import async_batched, batched
 
 DataBase = Union[SyncRedis, AsyncRedis]
 TMapper = TypeVar("TMapper", bound="BaseMapper")
 
+# hash field counting the writes to objects of VERSIONED classes
+REVISION_FIELD = 'revision'
+
+# KEYS: object key, ARGV: revision field
+# Counts a write of a non-VERSIONED class to an object that a VERSIONED class keeps a revision for,
+# the same way the job and control scripts do, so checked commits see the change
+_BUMP_SCRIPT = LuaScript("""
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+end
+return 0
+""")
+
+
+class ConflictError(ValueError):
+    """Raised when a checked commit finds the object was changed since it was read"""
+
+
+def _decode_bool(val: str) -> bool:
+    return val != 'False'
+
+
+def _encode_date(val: datetime) -> str:
+    return val.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+def _decode_date(val: str) -> datetime:
+    # fromisoformat is a lot faster than strptime, so use it for the two formats _encode_date
+    # produces with and without microseconds, "YYYY-mm-dd HH:MM:SS.ffffff" and "YYYY-mm-dd HH:MM:SS"
+    if len(val) in (19, 26) and val[10] == ' ' and val[16] == ':' and val[19:20] in ('', '.'):
+        try:
+            return datetime.fromisoformat(val)
+        except ValueError:
+            pass
+
+    # Fall back to strptime for odd legacy values
+    # We're not totally fixated on sub-second resolution
+    try:
+        return datetime.strptime(val, "%Y-%m-%d %H:%M:%S.%f")
+    except ValueError:
+        return datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
+
 
 class BaseMapper:
     """Base object mapper class"""
 
+    # keys are <KEY_PREFIX>:<ID>
+    KEY_PREFIX: str = ''
+
     ATTRIBUTES: tuple[str, ...] = ()
     PROPERTIES: tuple[str, ...] = ()
-    INTERNAL: tuple[str, ...] = ('_db', '_key')
+    INTERNAL: tuple[str, ...] = ('_db', '_dirty', '_key', '_loaded', '_raw', '_revision')
 
     __slots__: tuple[str, ...] = ATTRIBUTES + INTERNAL + tuple(['_%s' % p for p in PROPERTIES])
 
@@ -26,64 +76,194 @@ class BaseMapper:
     DATE_ARGS: set[str] = set()
     LIST_ARGS: set[str] = set()
 
+    # opt-in cache for full fetches, see the cache module
+    CACHE: Optional[ReadCache] = None
+
+    # opt-in write counter for optimistic concurrency, see commit(if_version=...)
+    VERSIONED: bool = False
+
+    # all stored fields and their codecs, filled in for each subclass
+    _FIELDS: frozenset[str] = frozenset()
+    _ENCODERS: dict[str, Optional[Callable[[Any], Any]]] = {}
+    _DECODERS: dict[str, Optional[Callable[[str], Any]]] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._FIELDS = frozenset(cls.PROPERTIES + cls.ATTRIBUTES)
+        cls._ENCODERS = {}
+        cls._DECODERS = {}
+        for arg in cls.PROPERTIES + cls.ATTRIBUTES:
+            cls._ENCODERS[arg], cls._DECODERS[arg] = cls._codec(arg)
+
+    @classmethod
+    def _codec(cls, arg: str) -> tuple[Optional[Callable[[Any], Any]], Optional[Callable[[str], Any]]]:
+        """Get the encoder and decoder for a field, None if the value is passed through unchanged"""
+        # redis can't handle bool or datetime types, int and float are fine
+        if arg in cls.BOOL_ARGS:
+            return str, _decode_bool
+        if arg in cls.INT_ARGS:
+            return None, int
+        if arg in cls.FLOAT_ARGS:
+            return None, float
+        if arg in cls.DATE_ARGS:
+            return _encode_date, _decode_date
+        if arg in cls.LIST_ARGS:
+            return json.dumps, json.loads
+        return None, None
+
     def __init__(self, db: DataBase, key: str) -> None:
+        # raw JSON of list fields that were fetched but not accessed yet
+        self._raw: dict[str, str] = {}
+        # None means the object was never synced with the database, so everything needs writing
+        self._dirty: Optional[set[str]] = None
+        # None unless only some of the fields were fetched
+        self._loaded: Optional[frozenset[str]] = None
         self._db: DataBase = db
         self._key: str = key
+        # revision as of the last fetch or checked commit, None if unknown
+        self._revision: Optional[int] = None
 
         for attribute in self.ATTRIBUTES:
-            setattr(self, attribute, None)
+            object.__setattr__(self, attribute, None)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        object.__setattr__(self, name, value)
+        if name in self._FIELDS:
+            self._raw.pop(name, None)
+            if self._dirty is not None:
+                self._dirty.add(name)
+
+    def __getattr__(self, name: str) -> Any:
+        # only called if the slot is empty, which is the case for list fields that weren't decoded yet
+        if name != '_raw' and name in self._raw:
+            val = json.loads(self._raw.pop(name))
+            object.__setattr__(self, name, val)
+            return val
+        raise AttributeError("{!r} object has no attribute {!r}".format(self.__class__.__name__, name))
+
+    def _mark_clean(self) -> None:
+        """Mark the object as in sync with the database"""
+        self._dirty = set()
+
+    @property
+    def revision(self) -> Optional[int]:
+        """Write counter of a VERSIONED object as of the last fetch or checked commit"""
+        return self._revision
+
+    @property
+    def is_partial(self) -> bool:
+        """True if only some of the fields were fetched from the database"""
+        return self._loaded is not None
+
+    @classmethod
+    def _fetch_args(cls, fields: Optional[Iterable[str]] = None) -> tuple[str, ...]:
+        """Get the fields to fetch, in storage order
+
+        :param fields: Subset of fields to fetch, or None for all fields
+        :return: Fields to fetch
+        """
+        args = cls.PROPERTIES + cls.ATTRIBUTES
+        if fields is None:
+            return args
+        requested = set(fields)
+        unknown = requested - cls._FIELDS
+        if unknown:
+            raise ValueError("Unknown {} fields: {}".format(cls.__name__, ", ".join(sorted(unknown))))
+        return tuple(arg for arg in args if arg in requested)
+
+    @classmethod
+    def _stored_args(cls, args: tuple[str, ...]) -> tuple[str, ...]:
+        """Get the hash fields to read for the given fields, adding the revision of VERSIONED classes"""
+        return args + (REVISION_FIELD,) if cls.VERSIONED else args
+
+    def _load(self, args: tuple[str, ...], values: list[Any]) -> None:
+        """Fill the object from values read for _stored_args and mark it as in sync with the database"""
+        if self.VERSIONED:
+            self._revision = int(values[-1] or 0)
+            values = values[:-1]
+        partial = len(args) < len(self._FIELDS)
+        # fetching a subset of an already complete object keeps it complete
+        if partial and (self._dirty is None or self._loaded is not None):
+            self._loaded = frozenset(args).union(self._loaded or ())
+        elif not partial:
+            self._loaded = None
+        self._parse(args, values)
+        self._mark_clean()
 
     def to_dict(self) -> dict[str, Any]:
-        ret: dict[str, Any] = {}
+        return self._serialise(self.PROPERTIES + self.ATTRIBUTES)
 
-        args: tuple[str, ...] = self.PROPERTIES + self.ATTRIBUTES
+    def _changes(self, full: bool = False) -> dict[str, Any]:
+        """Get the serialised fields that need writing to the database
 
-        for arg in args:
-            if getattr(self, arg) is not None:
-                arg_val = getattr(self, arg)
+        Unless full is set, only fields assigned since the last fetch or commit are included.
+        List fields can be changed in place, so they are included if they were loaded and accessed.
 
-                # redis can't handle bool or datetime types, int and float are fine
-                if arg in self.BOOL_ARGS:
-                    arg_val = str(arg_val)
-                elif arg in self.DATE_ARGS:
-                    arg_val = arg_val.strftime("%Y-%m-%d %H:%M:%S.%f")
-                elif arg in self.LIST_ARGS:
-                    arg_val = json.dumps(arg_val)
+        :param full: If True, include all fields
+        :return: Serialised fields to write
+        """
+        if full and self._loaded is not None:
+            raise ValueError("Can't fully commit partially fetched {} {}".format(self.__class__.__name__, self._key))
+        if full or self._dirty is None:
+            return self.to_dict()
+        dirty = self._dirty
+        raw = self._raw
+        loaded = self._FIELDS if self._loaded is None else self._loaded
+        args = tuple(arg for arg in self.PROPERTIES + self.ATTRIBUTES
+                     if arg in dirty or (arg in self.LIST_ARGS and arg in loaded and arg not in raw))
+        return self._serialise(args)
+
+    def _serialise(self, args: tuple[str, ...]) -> dict[str, Any]:
+        ret: dict[str, Any] = {}
+        encoders = self._ENCODERS
+        raw = self._raw
 
-                ret[arg] = arg_val
+        for arg in args:
+            # list fields that were never accessed are still encoded
+            if arg in raw:
+                ret[arg] = raw[arg]
+                continue
+            arg_val = getattr(self, arg)
+            if arg_val is None:
+                continue
+            encoder = encoders[arg]
+            ret[arg] = arg_val if encoder is None else encoder(arg_val)
 
         return ret
 
     def _parse(self, args, values) -> None:
-        for i, arg in enumerate(args):
-            val = values[i]
-
-            # Don't touch values that are unset
-            if val is None and getattr(self, arg) is None:
+        decoders = self._DECODERS
+        raw = self._raw
+        lazy = self.LIST_ARGS
+
+        for arg, val in zip(args, values):
+            # a list field that was never accessed has its value in raw and an empty slot
+            was_raw = raw.pop(arg, None) is not None
+            if val is not None and arg in lazy:
+                # only decode JSON list fields when they are first accessed
+                raw[arg] = val
+                try:
+                    object.__delattr__(self, arg)
+                except AttributeError:
+                    pass
                 continue
 
             if val is None:
+                # Don't touch values that are unset
+                if not was_raw and getattr(self, arg, None) is None:
+                    continue
                 # avoid type conversion for None values
                 # this allows 'unsetting' values that used to be set
                 # only create an empty list for list args
                 if arg in self.LIST_ARGS:
                     val = []
-            elif arg in self.BOOL_ARGS:
-                val = (val != 'False')
-            elif arg in self.INT_ARGS:
-                val = int(val)
-            elif arg in self.FLOAT_ARGS:
-                val = float(val)
-            elif arg in self.DATE_ARGS:
-                # We're not totally fixated on sub-second resolution
-                try:
-                    val = datetime.strptime(val, "%Y-%m-%d %H:%M:%S.%f")
-                except ValueError:
-                    val = datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
-            elif arg in self.LIST_ARGS:
-                val = json.loads(val)
+            else:
+                decoder = decoders[arg]
+                if decoder is not None:
+                    val = decoder(val)
 
-            setattr(self, arg, val)
+            # parsed values come from the database, so skip the change tracking in __setattr__
+            object.__setattr__(self, arg, val)
 
     @classmethod
     def fromExisting(cls: Type[TMapper], new_id: str, existing: TMapper) -> TMapper:
@@ -100,58 +280,525 @@ class BaseMapper:
         new._parse(args, values)
         return new
 
+    def _queue_commit(self, pipe, full: bool = False) -> bool:
+        """Queue the commands needed to commit this object on a pipeline
 
-def async_mixin(klass):
-    """Mixin for using aioredis for database connectivity"""
-    async def fetch(self):
-        args = self.PROPERTIES + self.ATTRIBUTES
-
-        exists = await self._db.exists(self._key)
+        :return: True if a write was queued as the first command, False if there was nothing to write
+        """
+        self._invalidate()
+        mapping = self._changes(full)
+        if mapping:
+            pipe.hset(self._key, mapping=mapping)
+            self._queue_bump(pipe)
+        self._queue_expire(pipe)
+        return bool(mapping)
+
+    def _queue_bump(self, pipe) -> None:
+        """Queue the revision increment of a write, only for objects that have a revision unless VERSIONED"""
+        if self.VERSIONED:
+            pipe.hincrby(self._key, REVISION_FIELD, 1)
+        else:
+            _BUMP_SCRIPT.queue(pipe, [self._key], REVISION_FIELD)
+
+    def _load_cached(self, args: tuple[str, ...], fields: Optional[Iterable[str]]) -> bool:
+        """Fill the object from the read cache, only used for full fetches
+
+        :return: True if the object was cached, False if it needs fetching from the database
+        """
+        cached = self.CACHE.get(self._key) if self.CACHE is not None and fields is None else None
+        if cached is None:
+            return False
+        self._load(args, cached)
+        return True
+
+    def _load_fetched(self, args: tuple[str, ...], fields: Optional[Iterable[str]], exists: int,
+                      values: list[Any]) -> None:
+        """Fill the object from the results of the commands queued by _queue_fetch, caching full fetches"""
         if exists == 0:
             raise ValueError("No {} with ID {} in database, can't fetch".
                              format(self.__class__.__name__, self._key))
+        if self.CACHE is not None and fields is None:
+            self.CACHE.put(self._key, values)
+        self._load(args, values)
 
-        values = await self._db.hmget(self._key, *args)
+    def _commit_result(self, wrote: bool, results: list[Any]) -> Any:
+        """Get the result of a commit and mark the object as in sync with the database"""
+        self._mark_clean()
+        return results[0] if wrote else 0
 
-        self._parse(args, values)
+    def _queue_checked(self, pipe, current: Optional[str], full: bool, if_version: int) -> bool:
+        """Queue a checked commit on a watching pipeline, see _queue_commit
+
+        :param current: Stored revision read after starting the WATCH
+        """
+        self._check_version(current, if_version)
+        pipe.multi()
+        wrote = self._queue_commit(pipe, full)
+        # the WATCH is gone after executing, so scripts can't be re-run and need loading up front
+        LuaScript.preload(pipe)
+        return wrote
+
+    @staticmethod
+    def _raise_if_last(err: ConflictError, attempt: int, retries: int) -> None:
+        """Re-raise the conflict of an update attempt once all retries are used up"""
+        if attempt == retries:
+            raise err
+
+    def _check_version(self, current: Optional[str], if_version: int) -> None:
+        """Raise a ConflictError unless the stored revision is the expected one"""
+        if not self.VERSIONED:
+            raise ValueError("{} is not versioned".format(self.__class__.__name__))
+        if int(current or 0) != if_version:
+            self._conflict(if_version)
+
+    def _conflict(self, if_version: int) -> None:
+        # whatever is cached is outdated as well
+        self._invalidate()
+        raise ConflictError("{} changed since revision {}".format(self._key, if_version))
+
+    def _checked_result(self, if_version: int, wrote: bool, results: list[Any]) -> Any:
+        """Get the result of a checked commit, updating the local revision"""
+        self._mark_clean()
+        if wrote:
+            self._revision = if_version + 1
+            return results[0]
+        self._revision = if_version
+        return 0
+
+    def _queue_incr(self, pipe, field: str, amount: Union[int, float]) -> None:
+        """Queue an atomic increment of a numeric field, followed by the expiry refresh"""
+        if field in self.INT_ARGS:
+            if not isinstance(amount, int):
+                raise ValueError("Can only increment {} by an integer, not {!r}".format(field, amount))
+            self._invalidate()
+            pipe.hincrby(self._key, field, amount)
+        elif field in self.FLOAT_ARGS:
+            self._invalidate()
+            pipe.hincrbyfloat(self._key, field, amount)
+        else:
+            raise ValueError("Can't increment non-numeric field {}".format(field))
+        self._queue_bump(pipe)
+        self._queue_expire(pipe)
+
+    def _apply_incr(self, field: str, value: Union[int, float]) -> Union[int, float]:
+        """Store the incremented value of a field without marking it dirty"""
+        value = self._DECODERS[field](value)  # type: ignore
+        object.__setattr__(self, field, value)
+        # the database value is newer than any pending local change
+        if self._dirty is not None:
+            self._dirty.discard(field)
+        return value
+
+    def decr_field(self, field: str, amount: Union[int, float] = 1):
+        """Atomically subtract from a numeric field, see incr_field
+
+        :param field: Name of an integer or float field
+        :param amount: Amount to subtract
+        :return: The new value, or a co-routine returning it for async classes
+        """
+        return self.incr_field(field, -amount)  # type: ignore
+
+    def _queue_delete(self, pipe) -> None:
+        """Queue the commands needed to delete this object on a pipeline"""
+        self._invalidate()
+        pipe.delete(self._key)
+
+    def _invalidate(self) -> None:
+        """Drop the object from the read cache, if there is one"""
+        if self.CACHE is not None:
+            self.CACHE.invalidate(self._key)
+
+    def _queue_expire(self, pipe) -> None:
+        """Queue commands setting the object's expiry, no-op for non-expiring objects"""
+        pass
+
+    @staticmethod
+    def _queue_many(pipe, objects: Iterable[BaseMapper], full: bool = False) -> list[tuple[int, bool]]:
+        """Queue commits for all objects on a pipeline
+
+        :return: Number of commands queued for each object, and whether a write was queued first
+        """
+        queued: list[tuple[int, bool]] = []
+        for obj in objects:
+            before = len(pipe)
+            wrote = obj._queue_commit(pipe, full)
+            queued.append((len(pipe) - before, wrote))
+        return queued
+
+    @staticmethod
+    def _split_results(objects: list[BaseMapper], queued: list[tuple[int, bool]], results: list[Any]) -> list[Any]:
+        """Reduce pipeline results to a single result per object
+
+        Each object gets the result of its write, 0 if there was nothing to write, or the first error
+        any of its commands raised. Successfully committed objects are marked as clean.
+        """
+        ret: list[Any] = []
+        offset = 0
+        for obj, (count, wrote) in zip(objects, queued):
+            own = results[offset:offset + count]
+            offset += count
+            errors = [res for res in own if isinstance(res, Exception)]
+            if errors:
+                ret.append(errors[0])
+                continue
+            ret.append(obj._commit_result(wrote, own))
+        return ret
+
+    @classmethod
+    def _from_id(cls: Type[TMapper], db: DataBase, obj_id: str) -> TMapper:
+        """Create an empty object for the given ID, to be filled by a fetch"""
+        return cls(db, obj_id)  # type: ignore
+
+    def _queue_fetch(self, pipe, args: tuple[str, ...]) -> None:
+        """Queue the commands needed to fetch this object on a pipeline"""
+        pipe.exists(self._key)
+        pipe.hmget(self._key, *self._stored_args(args))
+
+    @staticmethod
+    def _queue_fetch_many(pipe, objects: list[BaseMapper], args: tuple[str, ...]) -> None:
+        """Queue the commands needed to fetch all objects on a pipeline, see _hydrate_many"""
+        for obj in objects:
+            obj._queue_fetch(pipe, args)
+
+    @classmethod
+    def _iter_fields(cls, fields: Optional[Iterable[str]], filters: dict[str, Any]) -> Optional[set[str]]:
+        """Get the fields to fetch while iterating, making sure all filtered fields are loaded"""
+        for name in filters:
+            if not hasattr(cls, name):
+                raise ValueError("Can't filter {} on unknown attribute {}".format(cls.__name__, name))
+        if fields is None:
+            return None
+        return set(fields) | (set(filters) & cls._FIELDS)
+
+    @classmethod
+    def _id_from_key(cls, key: str) -> str:
+        return key[len(cls.KEY_PREFIX) + 1:]
+
+    @classmethod
+    def _ids_from_keys(cls, keys: list[str]) -> list[str]:
+        return [cls._id_from_key(key) for key in keys]
+
+    @staticmethod
+    def _filter_many(objects: list[Optional[TMapper]], filters: dict[str, Any]) -> list[TMapper]:
+        """Drop missing objects and objects not matching all filters
+
+        Filter values can be a single value or a set, list or tuple of allowed values.
+        """
+        ret: list[TMapper] = []
+        for obj in objects:
+            if obj is None:
+                continue
+            for name, expected in filters.items():
+                val = getattr(obj, name)
+                if isinstance(expected, (set, frozenset, list, tuple)):
+                    if val not in expected:
+                        break
+                elif val != expected:
+                    break
+            else:
+                ret.append(obj)
+        return ret
+
+    @staticmethod
+    def _hydrate_many(objects: list[TMapper], args: tuple[str, ...], results: list[Any]) -> list[Optional[TMapper]]:
+        """Fill objects from the results of the commands queued by _queue_fetch
+
+        :param objects: Objects to fill, in the order they were queued
+        :param args: Fields that were fetched
+        :param results: Pipeline results, two per object
+        :return: List of filled objects, None for objects missing from the database
+        """
+        ret: list[Optional[TMapper]] = []
+        for i, obj in enumerate(objects):
+            exists, values = results[2 * i], results[2 * i + 1]
+            if exists == 0:
+                ret.append(None)
+                continue
+            obj._load(args, values)
+            ret.append(obj)
+        return ret
+
+
+def async_mixin(klass):
+    """Mixin for using aioredis for database connectivity"""
+    async def fetch(self, fields: Optional[Iterable[str]] = None):
+        """Fetch the object from the database
+
+        :param fields: Only fetch these fields, marking the object as partially loaded
+        :return: The object itself
+        """
+        args = self._fetch_args(fields)
+        if self._load_cached(args, fields):
+            return self
+
+        # check existence and read the values in the same round trip
+        pipe = self._db.pipeline(transaction=False)
+        self._queue_fetch(pipe, args)
+        exists, values = await pipe.execute()
+        self._load_fetched(args, fields, exists, values)
         return self
 
-    async def commit(self):
-        return await self._db.hset(self._key, mapping=self.to_dict())
+    async def fetch_many(cls, db, ids: Iterable[str], fields: Optional[Iterable[str]] = None):
+        """Fetch multiple objects in a single pipelined round trip
+
+        :param db: Database connection to use
+        :param ids: IDs of the objects to fetch
+        :param fields: Only fetch these fields, marking the objects as partially loaded
+        :return: List of objects in the same order as ids, None for IDs not in the database
+        """
+        args = cls._fetch_args(fields)
+        objects = [cls._from_id(db, obj_id) for obj_id in ids]
+        pipe = db.pipeline(transaction=False)
+        cls._queue_fetch_many(pipe, objects, args)
+        results = await pipe.execute()
+        return cls._hydrate_many(objects, args, results)
+
+    async def iter_all(cls, db, batch_size: int = 100, fields: Optional[Iterable[str]] = None, **filters):
+        """Iterate over all objects of this type in the database
+
+        Keys are found with SCAN, so the server isn't blocked, and hydrated in pipelined batches,
+        so memory use is bounded by the batch size.
+
+        :param db: Database connection to use
+        :param batch_size: SCAN count hint and number of objects fetched per round trip
+        :param fields: Only fetch these fields, plus the ones filtered on
+        :param filters: Only yield objects with matching attributes, e.g. state='queued' or state={'queued', 'running'}
+        :return: Async generator of objects
+        """
+        fields = cls._iter_fields(fields, filters)
+        keys = db.scan_iter(match="{}:*".format(cls.KEY_PREFIX), count=batch_size, _type="hash")
+        async for batch in async_batched(keys, batch_size):
+            for obj in cls._filter_many(await cls.fetch_many(db, cls._ids_from_keys(batch), fields), filters):
+                yield obj
+
+    async def commit_many(cls, objects, transaction: bool = False, full: bool = False):
+        """Commit multiple objects in a single pipelined round trip
+
+        :param objects: Objects to commit, including their expiry if they have one
+        :param transaction: If True, wrap all commands in a MULTI/EXEC transaction
+        :param full: If True, write all fields instead of only the changed ones
+        :return: List of per-object results in the same order as objects, exceptions for failed commits
+        """
+        objects = list(objects)
+        if not objects:
+            return []
+        pipe = objects[0]._db.pipeline(transaction=transaction)
+        queued = cls._queue_many(pipe, objects, full)
+        results = await async_execute(pipe, raise_on_error=False)
+        return cls._split_results(objects, queued, results)
+
+    async def commit(self, full: bool = False, if_version: Optional[int] = None):
+        """Write fields changed since the last fetch or commit, or all fields if full is set
+
+        :param full: If True, write all fields instead of only the changed ones
+        :param if_version: Only write if the stored revision still is this one, e.g. self.revision,
+                           raising a ConflictError otherwise. Only for VERSIONED classes.
+        :return: Result of the write, 0 if there was nothing to write
+        """
+        if if_version is not None:
+            return await self._commit_checked(full, if_version)
+        pipe = self._db.pipeline(transaction=False)
+        wrote = self._queue_commit(pipe, full)
+        results = await async_execute(pipe) if len(pipe) else []
+        return self._commit_result(wrote, results)
+
+    async def _commit_checked(self, full: bool, if_version: int):
+        async with self._db.pipeline(transaction=True) as pipe:
+            await pipe.watch(self._key)
+            wrote = self._queue_checked(pipe, await pipe.hget(self._key, REVISION_FIELD), full, if_version)
+            try:
+                results = await pipe.execute()
+            except WatchError:
+                self._conflict(if_version)
+        return self._checked_result(if_version, wrote, results)
+
+    async def update(self, mutate: Callable[[Any], Any], retries: int = 3):
+        """Apply a change with optimistic concurrency, retrying on conflicts
+
+        Fetches the object, calls mutate on it and commits if nobody else wrote it in the meantime.
+        On a conflict, this is repeated with a fresh fetch, so mutate must only depend on the object.
+        Only for VERSIONED classes.
+
+        :param mutate: Function changing the object passed to it
+        :param retries: Number of times to retry after a conflict
+        :return: Result of the write
+        """
+        for attempt in range(retries + 1):
+            await self.fetch()
+            mutate(self)
+            try:
+                return await self.commit(if_version=self.revision)
+            except ConflictError as err:
+                self._raise_if_last(err, attempt, retries)
+
+    async def incr_field(self, field: str, amount: Union[int, float] = 1):
+        """Atomically add to a numeric field, without a read-modify-write commit
+
+        The local object is updated with the new value and the expiry, if any, refreshed in the same round trip.
+
+        :param field: Name of an integer or float field
+        :param amount: Amount to add, may be negative
+        :return: The new value
+        """
+        pipe = self._db.pipeline(transaction=True)
+        self._queue_incr(pipe, field, amount)
+        return self._apply_incr(field, (await async_execute(pipe))[0])
 
     async def delete(self):
-        return await self._db.delete(self._key)
+        pipe = self._db.pipeline(transaction=True)
+        self._queue_delete(pipe)
+        return (await async_execute(pipe))[0]
 
     klass.fetch = fetch
+    klass.fetch_many = classmethod(fetch_many)
     klass.commit = commit
+    klass.commit_many = classmethod(commit_many)
+    klass.iter_all = classmethod(iter_all)
     klass.delete = delete
+    klass.incr_field = incr_field
+    klass._commit_checked = _commit_checked
+    klass.update = update
 
     return klass
 
 
 def sync_mixin(klass):
     """Mixin for using redis for database connectivity"""
-    def fetch(self):
-        args = self.PROPERTIES + self.ATTRIBUTES
+    def fetch(self, fields: Optional[Iterable[str]] = None):
+        """Fetch the object from the database
 
-        exists = self._db.exists(self._key)
-        if exists == 0:
-            raise ValueError("No {} with ID {} in database, can't fetch".
-                             format(self.__class__.__name__, self._key))
-
-        values = self._db.hmget(self._key, *args)
-
-        self._parse(args, values)
+        :param fields: Only fetch these fields, marking the object as partially loaded
+        :return: The object itself
+        """
+        args = self._fetch_args(fields)
+        if self._load_cached(args, fields):
+            return self
+
+        # check existence and read the values in the same round trip
+        pipe = self._db.pipeline(transaction=False)
+        self._queue_fetch(pipe, args)
+        exists, values = pipe.execute()
+        self._load_fetched(args, fields, exists, values)
         return self
 
-    def commit(self):
-        return self._db.hset(self._key, mapping=self.to_dict())
+    def fetch_many(cls, db, ids: Iterable[str], fields: Optional[Iterable[str]] = None):
+        """Fetch multiple objects in a single pipelined round trip
+
+        :param db: Database connection to use
+        :param ids: IDs of the objects to fetch
+        :param fields: Only fetch these fields, marking the objects as partially loaded
+        :return: List of objects in the same order as ids, None for IDs not in the database
+        """
+        args = cls._fetch_args(fields)
+        objects = [cls._from_id(db, obj_id) for obj_id in ids]
+        pipe = db.pipeline(transaction=False)
+        cls._queue_fetch_many(pipe, objects, args)
+        results = pipe.execute()
+        return cls._hydrate_many(objects, args, results)
+
+    def iter_all(cls, db, batch_size: int = 100, fields: Optional[Iterable[str]] = None, **filters):
+        """Iterate over all objects of this type in the database
+
+        Keys are found with SCAN, so the server isn't blocked, and hydrated in pipelined batches,
+        so memory use is bounded by the batch size.
+
+        :param db: Database connection to use
+        :param batch_size: SCAN count hint and number of objects fetched per round trip
+        :param fields: Only fetch these fields, plus the ones filtered on
+        :param filters: Only yield objects with matching attributes, e.g. state='queued' or state={'queued', 'running'}
+        :return: Generator of objects
+        """
+        fields = cls._iter_fields(fields, filters)
+        keys = db.scan_iter(match="{}:*".format(cls.KEY_PREFIX), count=batch_size, _type="hash")
+        for batch in batched(keys, batch_size):
+            yield from cls._filter_many(cls.fetch_many(db, cls._ids_from_keys(batch), fields), filters)
+
+    def commit_many(cls, objects, transaction: bool = False, full: bool = False):
+        """Commit multiple objects in a single pipelined round trip
+
+        :param objects: Objects to commit, including their expiry if they have one
+        :param transaction: If True, wrap all commands in a MULTI/EXEC transaction
+        :param full: If True, write all fields instead of only the changed ones
+        :return: List of per-object results in the same order as objects, exceptions for failed commits
+        """
+        objects = list(objects)
+        if not objects:
+            return []
+        pipe = objects[0]._db.pipeline(transaction=transaction)
+        queued = cls._queue_many(pipe, objects, full)
+        results = execute(pipe, raise_on_error=False)
+        return cls._split_results(objects, queued, results)
+
+    def commit(self, full: bool = False, if_version: Optional[int] = None):
+        """Write fields changed since the last fetch or commit, or all fields if full is set
+
+        :param full: If True, write all fields instead of only the changed ones
+        :param if_version: Only write if the stored revision still is this one, e.g. self.revision,
+                           raising a ConflictError otherwise. Only for VERSIONED classes.
+        :return: Result of the write, 0 if there was nothing to write
+        """
+        if if_version is not None:
+            return self._commit_checked(full, if_version)
+        pipe = self._db.pipeline(transaction=False)
+        wrote = self._queue_commit(pipe, full)
+        results = execute(pipe) if len(pipe) else []
+        return self._commit_result(wrote, results)
+
+    def _commit_checked(self, full: bool, if_version: int):
+        with self._db.pipeline(transaction=True) as pipe:
+            pipe.watch(self._key)
+            wrote = self._queue_checked(pipe, pipe.hget(self._key, REVISION_FIELD), full, if_version)
+            try:
+                results = pipe.execute()
+            except WatchError:
+                self._conflict(if_version)
+        return self._checked_result(if_version, wrote, results)
+
+    def update(self, mutate: Callable[[Any], Any], retries: int = 3):
+        """Apply a change with optimistic concurrency, retrying on conflicts
+
+        Fetches the object, calls mutate on it and commits if nobody else wrote it in the meantime.
+        On a conflict, this is repeated with a fresh fetch, so mutate must only depend on the object.
+        Only for VERSIONED classes.
+
+        :param mutate: Function changing the object passed to it
+        :param retries: Number of times to retry after a conflict
+        :return: Result of the write
+        """
+        for attempt in range(retries + 1):
+            self.fetch()
+            mutate(self)
+            try:
+                return self.commit(if_version=self.revision)
+            except ConflictError as err:
+                self._raise_if_last(err, attempt, retries)
+
+    def incr_field(self, field: str, amount: Union[int, float] = 1):
+        """Atomically add to a numeric field, without a read-modify-write commit
+
+        The local object is updated with the new value and the expiry, if any, refreshed in the same round trip.
+
+        :param field: Name of an integer or float field
+        :param amount: Amount to add, may be negative
+        :return: The new value
+        """
+        pipe = self._db.pipeline(transaction=True)
+        self._queue_incr(pipe, field, amount)
+        return self._apply_incr(field, execute(pipe)[0])
 
     def delete(self):
-        return self._db.delete(self._key)
+        pipe = self._db.pipeline(transaction=True)
+        self._queue_delete(pipe)
+        return execute(pipe)[0]
 
     klass.fetch = fetch
+    klass.fetch_many = classmethod(fetch_many)
     klass.commit = commit
+    klass.commit_many = classmethod(commit_many)
+    klass.iter_all = classmethod(iter_all)
     klass.delete = delete
+    klass.incr_field = incr_field
+    klass._commit_checked = _commit_checked
+    klass.update = update
 
     return klass
@@ -0,0 +1,103 @@
+"""Opt-in in-process read cache for mapper fetches
+
+Enable it per class, e.g. ``SyncNotice.CACHE = ReadCache(max_size=128, ttl=30)``.
+Local commits and deletes invalidate entries directly. Changes made by other
+processes are picked up from Redis keyspace notifications, which need to be
+enabled on the server with ``CONFIG SET notify-keyspace-events Kghx``.
+"""
+from __future__ import annotations
+from collections import OrderedDict
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from .utils import keyspace_key
+
+
+class ReadCache:
+    """LRU cache of fetched field values with a TTL"""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._clock = clock
+        self._entries: OrderedDict[str, tuple[float, list[Any]]] = OrderedDict()
+        # invalidations can come in from a listener thread
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[list[Any]]:
+        """Get the cached values for a key, None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self._clock():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, values: list[Any]) -> None:
+        """Cache the values for a key, evicting the least recently used entry if full"""
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, values)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: str) -> None:
+        """Drop a key from the cache"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop all keys from the cache"""
+        with self._lock:
+            self._entries.clear()
+
+    def handle_message(self, message: dict[str, Any]) -> None:
+        """Invalidate the key a keyspace notification is about"""
+        if message.get('type') not in ('message', 'pmessage'):
+            return
+        key = keyspace_key(message['channel'])
+        if key:
+            self.invalidate(key)
+
+    @staticmethod
+    def patterns(prefixes: tuple[str, ...]) -> list[str]:
+        """Get the keyspace notification channel patterns for the given key prefixes"""
+        return ['__keyspace@*__:{}:*'.format(prefix) for prefix in prefixes]
+
+    def listen(self, db, *prefixes: str, sleep_time: float = 1.0):
+        """Invalidate keys changed by other clients from a daemon thread
+
+        :param db: Sync database connection to subscribe with
+        :param prefixes: Key prefixes to watch, e.g. SyncNotice.KEY_PREFIX
+        :param sleep_time: Poll interval of the listener thread
+        :return: The listener thread, call stop() on it to shut down
+        """
+        pubsub = db.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(**{pattern: self.handle_message for pattern in self.patterns(prefixes)})
+        return pubsub.run_in_thread(sleep_time=sleep_time, daemon=True)
+
+    async def listen_async(self, db, *prefixes: str) -> None:
+        """Invalidate keys changed by other clients, run this as an asyncio task
+
+        :param db: Async database connection to subscribe with
+        :param prefixes: Key prefixes to watch, e.g. AsyncNotice.KEY_PREFIX
+        """
+        pubsub = db.pubsub(ignore_subscribe_messages=True)
+        await pubsub.psubscribe(*self.patterns(prefixes))
+        try:
+            async for message in pubsub.listen():
+                self.handle_message(message)
+        finally:
+            # redis-py 5.0.1 renamed reset to aclose
+            await getattr(pubsub, 'aclose', pubsub.reset)()
@@ -1,15 +1,75 @@
 """antiSMASH worker control abstraction"""
 from __future__ import annotations
-from functools import wraps
+import asyncio
+import threading
+from typing import Any, Optional, Type, TypeVar
+from warnings import warn
+
+from redis.exceptions import RedisError
+
 from .base import BaseMapper, DataBase, async_mixin, sync_mixin
+from .scripts import LuaScript, async_execute, execute
+from .utils import now, to_timestamp
 
 
 CONTROL_TIMEOUT = 300
+# default share of CONTROL_TIMEOUT between two heartbeats
+HEARTBEAT_FRACTION = 0.5
+# sorted set of dispatcher names, scored by the timestamp their lease on running jobs lapses
+LEASES_KEY = 'controls:leases'
+
+TControl = TypeVar("TControl", bound="BaseControl")
+
+# KEYS: leases, ARGV: current timestamp, key prefix, fields to fetch
+# Returns name and field values for every dispatcher with a current lease whose control key still exists
+_LIVE_SCRIPT = LuaScript("""
+local ret = {}
+for _, name in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf')) do
+    local key = ARGV[2] .. ':' .. name
+    if redis.call('EXISTS', key) == 1 then
+        table.insert(ret, name)
+        table.insert(ret, redis.call('HMGET', key, unpack(ARGV, 3)))
+    end
+end
+return ret
+""")
+
+# KEYS: leases, ARGV: current timestamp, key prefix, fields to fetch
+# The control keys are built from the names in the leases, see the scripts module.
+# Picks the live dispatcher with the lowest share of its max_jobs in use, skipping stopping and full ones,
+# increments its running_jobs and returns its name and field values, or nil if none has a free slot
+_RESERVE_SCRIPT = LuaScript("""
+local best, best_key, best_load
+for _, name in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '(' .. ARGV[1], '+inf')) do
+    local key = ARGV[2] .. ':' .. name
+    local running, stop_scheduled, max_jobs, running_jobs = unpack(
+        redis.call('HMGET', key, 'running', 'stop_scheduled', 'max_jobs', 'running_jobs'))
+    max_jobs = tonumber(max_jobs) or 0
+    running_jobs = tonumber(running_jobs) or 0
+    if running == 'True' and stop_scheduled ~= 'True' and running_jobs < max_jobs then
+        local load = running_jobs / max_jobs
+        if not best or load < best_load then
+            best, best_key, best_load = name, key, load
+        end
+    end
+end
+if not best then
+    return nil
+end
+redis.call('HINCRBY', best_key, 'running_jobs', 1)
+-- count the write for versioned controls
+if redis.call('HEXISTS', best_key, 'revision') == 1 then
+    redis.call('HINCRBY', best_key, 'revision', 1)
+end
+return {best, redis.call('HMGET', best_key, unpack(ARGV, 3))}
+""")
 
 
 class BaseControl(BaseMapper):
     """Dispatcher management object"""
 
+    KEY_PREFIX = 'control'
+
     ATTRIBUTES = (
         'max_jobs',
         'name',
@@ -22,7 +82,12 @@ class BaseControl(BaseMapper):
 
     INTERNAL = (
         '_db',
+        '_dirty',
+        '_heartbeat',
         '_key',
+        '_loaded',
+        '_raw',
+        '_revision',
     )
 
     # Meh, needs to be repeated if we want to allow subclasses to have restricted attributes
@@ -39,7 +104,7 @@ class BaseControl(BaseMapper):
     }
 
     def __init__(self, db: DataBase, name: str, max_jobs: int, version: str = "unknown") -> None:
-        super(BaseControl, self).__init__(db, "control:{}".format(name))
+        super(BaseControl, self).__init__(db, "{}:{}".format(self.KEY_PREFIX, name))
         self.name = name
         self.stop_scheduled: bool = False
         self.running: bool = True
@@ -47,44 +112,272 @@ class BaseControl(BaseMapper):
         self.max_jobs: int = max_jobs
         self.running_jobs: int = 0
         self.version: str = version
+        # background heartbeat task or thread, see start_heartbeat
+        self._heartbeat: Any = None
+
+    @classmethod
+    def _from_id(cls: Type[TControl], db: DataBase, obj_id: str) -> TControl:
+        # max_jobs will be overwritten by the fetch
+        return cls(db, obj_id, 0)
+
+    @staticmethod
+    def _heartbeat_interval(fraction: float) -> float:
+        """Get the seconds between two heartbeats"""
+        if not 0 < fraction < 1:
+            raise ValueError("Heartbeat fraction must be between 0 and 1, not {}".format(fraction))
+        return CONTROL_TIMEOUT * fraction
+
+    def _queue_beat(self, pipe) -> dict[str, Any]:
+        """Queue a heartbeat carrying any pending changes
+
+        :return: The changes queued, to be passed to _mark_written once the pipeline ran
+        """
+        self._invalidate()
+        written = self._changes()
+        if written:
+            pipe.hset(self._key, mapping=written)
+            self._queue_bump(pipe)
+        self._queue_expire(pipe)
+        return written
+
+    def _mark_written(self, written: dict[str, Any]) -> None:
+        """Mark fields written by a heartbeat clean, unless they were changed again while it was in flight"""
+        current = self._serialise(tuple(written))
+        if self._dirty is None:
+            self._dirty = set(self._FIELDS)
+        for name, value in written.items():
+            if current.get(name) == value:
+                self._dirty.discard(name)
+
+    def _warn_beat_failed(self, err: RedisError) -> None:
+        warn("Heartbeat of {} failed, retrying: {}".format(self._key, err), RuntimeWarning)
+
+    @classmethod
+    def _queue_live(cls, pipe) -> None:
+        """Queue the script finding all live dispatchers"""
+        _LIVE_SCRIPT.queue(pipe, [LEASES_KEY], to_timestamp(now()), cls.KEY_PREFIX, *cls._stored_args(cls.ATTRIBUTES))
+
+    @classmethod
+    def _hydrate_live(cls: Type[TControl], db: DataBase, result: list[Any]) -> list[TControl]:
+        """Create controls from the result of the live dispatchers script"""
+        controls = []
+        for i in range(0, len(result), 2):
+            control = cls._from_id(db, result[i])
+            control._load(cls.ATTRIBUTES, result[i + 1])
+            controls.append(control)
+        return controls
+
+    @classmethod
+    def _queue_reserve(cls, pipe) -> None:
+        """Queue the script reserving a slot on the least loaded dispatcher"""
+        _RESERVE_SCRIPT.queue(pipe, [LEASES_KEY], to_timestamp(now()), cls.KEY_PREFIX,
+                              *cls._stored_args(cls.ATTRIBUTES))
+
+    @classmethod
+    def _hydrate_reserved(cls: Type[TControl], db: DataBase, result: Optional[list[Any]]) -> Optional[TControl]:
+        """Create the control returned by the reserve script"""
+        if result is None:
+            return None
+        control = cls._from_id(db, result[0])
+        control._invalidate()
+        control._load(cls.ATTRIBUTES, result[1])
+        return control
+
+
+def _queue_expire(self, pipe) -> None:
+    pipe.expire(self._key, CONTROL_TIMEOUT)
+    # the lease covers the jobs the dispatcher is running, see BaseJob.reap
+    pipe.zadd(LEASES_KEY, {self.name: to_timestamp(now()) + CONTROL_TIMEOUT})
 
 
 def expiring_async_mixin(klass):
     """Override async_mixin to expire the object"""
-    def commit_expire(fn):
-        @wraps(fn)
-        async def wrapper(self):
-            ret = await fn(self)
-            await self._db.expire(self._key, CONTROL_TIMEOUT)
-            return ret
-        return wrapper
+    async def commit(self, full: bool = False, if_version: Optional[int] = None):
+        if if_version is not None:
+            return await self._commit_checked(full, if_version)
+        # HSET and EXPIRE go out in one transaction, so the key never exists without a TTL
+        pipe = self._db.pipeline(transaction=True)
+        wrote = self._queue_commit(pipe, full)
+        return self._commit_result(wrote, await async_execute(pipe))
+
+    async def alive(self, status: Optional[str] = None):
+        """Refresh the expiry, writing a new status and any other pending changes in the same transaction"""
+        if status is not None:
+            self.status = status
+        pipe = self._db.pipeline(transaction=True)
+        if status is None and not self._dirty:
+            self._queue_expire(pipe)
+            return (await pipe.execute())[0]
+        self._queue_commit(pipe)
+        results = await async_execute(pipe)
+        self._mark_clean()
+        # return the result of the EXPIRE, queued before the lease update
+        return results[-2]
 
-    async def alive(self):
-        return await self._db.expire(self._key, CONTROL_TIMEOUT)
+    async def _run_heartbeat(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            pipe = self._db.pipeline(transaction=True)
+            written = self._queue_beat(pipe)
+            try:
+                await async_execute(pipe)
+            except RedisError as err:
+                self._warn_beat_failed(err)
+                continue
+            self._mark_written(written)
+
+    def start_heartbeat(self, fraction: float = HEARTBEAT_FRACTION) -> asyncio.Task:
+        """Refresh the expiry from a background task, writing pending changes along with it
+
+        :param fraction: Share of CONTROL_TIMEOUT to wait between two heartbeats
+        :return: The heartbeat task
+        """
+        if self._heartbeat is not None:
+            raise ValueError("Heartbeat of {} already running".format(self._key))
+        self._heartbeat = asyncio.create_task(self._run_heartbeat(self._heartbeat_interval(fraction)))
+        return self._heartbeat
+
+    async def stop_heartbeat(self) -> None:
+        """Stop the background heartbeat, if running"""
+        task, self._heartbeat = self._heartbeat, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def live(cls, db):
+        """Get all dispatchers with a current lease, in a single round trip
+
+        :param db: Database connection to use
+        :return: List of controls ordered by lease expiry
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_live(pipe)
+        return cls._hydrate_live(db, (await async_execute(pipe))[0])
+
+    async def reserve(cls, db):
+        """Atomically pick the least loaded live dispatcher and take a slot on it
+
+        Dispatchers that are not running, have a stop scheduled or are at max_jobs are skipped.
+        The slot is taken by incrementing running_jobs.
+
+        :param db: Database connection to use
+        :return: The control of the chosen dispatcher, or None if no dispatcher has a free slot
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_reserve(pipe)
+        return cls._hydrate_reserved(db, (await async_execute(pipe))[0])
 
     klass = async_mixin(klass)
-    klass.commit = commit_expire(klass.commit)
+    klass.commit = commit
     klass.alive = alive
+    klass._run_heartbeat = _run_heartbeat
+    klass.start_heartbeat = start_heartbeat
+    klass.stop_heartbeat = stop_heartbeat
+    klass.live = classmethod(live)
+    klass.reserve = classmethod(reserve)
+    klass._queue_expire = _queue_expire
 
     return klass
 
 
 def expiring_sync_mixin(klass):
     """Override the sync_mixin to expire the object"""
-    def commit_expire(fn):
-        @wraps(fn)
-        def wrapper(self):
-            ret = fn(self)
-            self._db.expire(self._key, CONTROL_TIMEOUT)
-            return ret
-        return wrapper
+    def commit(self, full: bool = False, if_version: Optional[int] = None):
+        if if_version is not None:
+            return self._commit_checked(full, if_version)
+        # HSET and EXPIRE go out in one transaction, so the key never exists without a TTL
+        pipe = self._db.pipeline(transaction=True)
+        wrote = self._queue_commit(pipe, full)
+        return self._commit_result(wrote, execute(pipe))
+
+    def alive(self, status: Optional[str] = None):
+        """Refresh the expiry, writing a new status and any other pending changes in the same transaction"""
+        if status is not None:
+            self.status = status
+        pipe = self._db.pipeline(transaction=True)
+        if status is None and not self._dirty:
+            self._queue_expire(pipe)
+            return (pipe.execute())[0]
+        self._queue_commit(pipe)
+        results = execute(pipe)
+        self._mark_clean()
+        # return the result of the EXPIRE, queued before the lease update
+        return results[-2]
+
+    def _run_heartbeat(self, interval: float, stopped: threading.Event) -> None:
+        while not stopped.wait(interval):
+            pipe = self._db.pipeline(transaction=True)
+            written = self._queue_beat(pipe)
+            try:
+                execute(pipe)
+            except RedisError as err:
+                self._warn_beat_failed(err)
+                continue
+            self._mark_written(written)
+
+    def start_heartbeat(self, fraction: float = HEARTBEAT_FRACTION) -> threading.Thread:
+        """Refresh the expiry from a daemon thread, writing pending changes along with it
+
+        :param fraction: Share of CONTROL_TIMEOUT to wait between two heartbeats
+        :return: The heartbeat thread
+        """
+        if self._heartbeat is not None:
+            raise ValueError("Heartbeat of {} already running".format(self._key))
+        stopped = threading.Event()
+        thread = threading.Thread(target=self._run_heartbeat, args=(self._heartbeat_interval(fraction), stopped),
+                                  name="heartbeat-{}".format(self.name), daemon=True)
+        self._heartbeat = (thread, stopped)
+        thread.start()
+        return thread
+
+    def stop_heartbeat(self, timeout: Optional[float] = None) -> None:
+        """Stop the background heartbeat, if running, and wait for the thread to finish
+
+        :param timeout: Maximum number of seconds to wait for the thread
+        """
+        heartbeat, self._heartbeat = self._heartbeat, None
+        if heartbeat is None:
+            return
+        thread, stopped = heartbeat
+        stopped.set()
+        thread.join(timeout)
+
+    def live(cls, db):
+        """Get all dispatchers with a current lease, in a single round trip
+
+        :param db: Database connection to use
+        :return: List of controls ordered by lease expiry
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_live(pipe)
+        return cls._hydrate_live(db, execute(pipe)[0])
+
+    def reserve(cls, db):
+        """Atomically pick the least loaded live dispatcher and take a slot on it
+
+        Dispatchers that are not running, have a stop scheduled or are at max_jobs are skipped.
+        The slot is taken by incrementing running_jobs.
 
-    def alive(self):
-        return self._db.expire(self._key, CONTROL_TIMEOUT)
+        :param db: Database connection to use
+        :return: The control of the chosen dispatcher, or None if no dispatcher has a free slot
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_reserve(pipe)
+        return cls._hydrate_reserved(db, execute(pipe)[0])
 
     klass = sync_mixin(klass)
-    klass.commit = commit_expire(klass.commit)
+    klass.commit = commit
     klass.alive = alive
+    klass._run_heartbeat = _run_heartbeat
+    klass.start_heartbeat = start_heartbeat
+    klass.stop_heartbeat = stop_heartbeat
+    klass.live = classmethod(live)
+    klass.reserve = classmethod(reserve)
+    klass._queue_expire = _queue_expire
 
     return klass
 
@@ -0,0 +1,146 @@
+"""Consumers for the job state change stream
+
+State changes are only recorded if enabled, e.g. ``SyncJob.EVENTS_MAX_LENGTH = 10000``,
+for every process committing or claiming jobs.
+"""
+from __future__ import annotations
+from typing import Any, NamedTuple, Optional
+
+from redis import Redis as SyncRedis
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import ResponseError
+
+from .base import DataBase
+from .job import EVENTS_KEY
+
+
+class JobEvent(NamedTuple):
+    """A single job state change"""
+    event_id: str
+    job_id: str
+    taxon: str
+    # empty for newly created jobs
+    old_state: str
+    new_state: str
+
+
+class BaseEventConsumer:
+    """Consumer group member reading job state changes in batches"""
+
+    _db: DataBase
+
+    def __init__(self, db: DataBase, group: str, consumer: str, stream: str = EVENTS_KEY) -> None:
+        self._db = db
+        self.group = group
+        self.consumer = consumer
+        self.stream = stream
+
+    @staticmethod
+    def _parse(entries: list[Any]) -> list[JobEvent]:
+        """Create events from stream entries"""
+        return [JobEvent(event_id, fields['job_id'], fields['taxon'], fields['old_state'], fields['new_state'])
+                for event_id, fields in entries]
+
+    def _parse_read(self, result: Optional[list[Any]]) -> list[JobEvent]:
+        """Create events from an XREADGROUP result"""
+        if not result:
+            return []
+        return self._parse(result[0][1])
+
+    @staticmethod
+    def _ignore_busy_group(err: ResponseError) -> None:
+        """Swallow the error for an already existing group"""
+        if not str(err).startswith('BUSYGROUP'):
+            raise err
+
+
+class AsyncEventConsumer(BaseEventConsumer):
+    """Event consumer using co-routines"""
+
+    _db: AsyncRedis
+
+    async def create_group(self, start_id: str = '$') -> None:
+        """Create the consumer group and the stream if needed, a no-op if the group exists
+
+        :param start_id: ID to start reading after, '$' for new events only, '0' for all retained events
+        """
+        try:
+            await self._db.xgroup_create(self.stream, self.group, id=start_id, mkstream=True)
+        except ResponseError as err:
+            self._ignore_busy_group(err)
+
+    async def read(self, count: int = 100, block: Optional[int] = None) -> list[JobEvent]:
+        """Read a batch of events not yet delivered to any consumer of the group
+
+        :param count: Maximum number of events to read
+        :param block: Milliseconds to wait for new events, None to return right away
+        :return: List of events, to be passed to ack once handled
+        """
+        return self._parse_read(await self._db.xreadgroup(self.group, self.consumer, {self.stream: '>'},
+                                                          count=count, block=block))
+
+    async def ack(self, *events: JobEvent) -> int:
+        """Mark events as handled
+
+        :param events: Events to acknowledge
+        :return: Number of events acknowledged
+        """
+        if not events:
+            return 0
+        return await self._db.xack(self.stream, self.group, *(event.event_id for event in events))
+
+    async def reclaim(self, min_idle_time: int, count: int = 100) -> list[JobEvent]:
+        """Take over events delivered to other consumers but not acknowledged in time
+
+        :param min_idle_time: Milliseconds an event must have been pending for
+        :param count: Maximum number of events to take over
+        :return: List of events, to be passed to ack once handled
+        """
+        result = await self._db.xautoclaim(self.stream, self.group, self.consumer, min_idle_time, count=count)
+        return self._parse(result[1])
+
+
+class SyncEventConsumer(BaseEventConsumer):
+    """Event consumer using sync functions"""
+
+    _db: SyncRedis
+
+    def create_group(self, start_id: str = '$') -> None:
+        """Create the consumer group and the stream if needed, a no-op if the group exists
+
+        :param start_id: ID to start reading after, '$' for new events only, '0' for all retained events
+        """
+        try:
+            self._db.xgroup_create(self.stream, self.group, id=start_id, mkstream=True)
+        except ResponseError as err:
+            self._ignore_busy_group(err)
+
+    def read(self, count: int = 100, block: Optional[int] = None) -> list[JobEvent]:
+        """Read a batch of events not yet delivered to any consumer of the group
+
+        :param count: Maximum number of events to read
+        :param block: Milliseconds to wait for new events, None to return right away
+        :return: List of events, to be passed to ack once handled
+        """
+        return self._parse_read(self._db.xreadgroup(self.group, self.consumer, {self.stream: '>'},
+                                                    count=count, block=block))
+
+    def ack(self, *events: JobEvent) -> int:
+        """Mark events as handled
+
+        :param events: Events to acknowledge
+        :return: Number of events acknowledged
+        """
+        if not events:
+            return 0
+        return self._db.xack(self.stream, self.group, *(event.event_id for event in events))
+
+    def reclaim(self, min_idle_time: int, count: int = 100) -> list[JobEvent]:
+        """Take over events delivered to other consumers but not acknowledged in time
+
+        :param min_idle_time: Milliseconds an event must have been pending for
+        :param count: Maximum number of events to take over
+        :return: List of events, to be passed to ack once handled
+        """
+        result = self._db.xautoclaim(self.stream, self.group, self.consumer, min_idle_time, count=count)
+        return self._parse(result[1])
@@ -1,18 +1,119 @@
 """antiSMASH job abstraction"""
 from __future__ import annotations
 from datetime import datetime
+import json
 import string
-from typing import Any, Optional, Type, TypeVar, Union
+from typing import Any, Iterable, Optional, Type, TypeVar, Union
 from warnings import warn
 
-from .base import BaseMapper, DataBase, async_mixin, sync_mixin
-from .utils import now
+from .base import BaseMapper, DataBase, _encode_date, async_mixin, sync_mixin
+from .control import CONTROL_TIMEOUT, LEASES_KEY
+from .scripts import LuaScript, async_execute, execute
+from .utils import async_batched, batched, now, to_timestamp
+from .watch import KeyWatcher
 
 TJob = TypeVar("TJob", bound="BaseJob")
 
+# secondary indexes are sets of job IDs, keyed <INDEX_PREFIX>:<field>:<value>
+INDEX_PREFIX = 'jobs'
+INDEXED_FIELDS = ('state', 'dispatcher', 'jobtype')
+# per taxon and state job counts, as <taxon>:<state> fields of a single hash
+STATS_KEY = 'jobs:stats'
+# stream of job state changes, see BaseJob.EVENTS_MAX_LENGTH and the events module
+EVENTS_KEY = 'jobs:events'
+
+# Lua snippet shared by the job scripts, keeps the indexes of one job in sync with its hash.
+# The index sets, stats hash and events stream aren't declared in KEYS, see the scripts module.
+_LUA_INDEXES = """
+local prefix = '""" + INDEX_PREFIX + """'
+local stats_key = '""" + STATS_KEY + """'
+local events_key = '""" + EVENTS_KEY + """'
+local indexed = {""" + ", ".join("'{}'".format(field) for field in INDEXED_FIELDS) + """}
+
+local function update_indexes(job_id, old, new)
+    for i, field in ipairs(indexed) do
+        if old[i] and old[i] ~= new[i] then
+            redis.call('SREM', prefix .. ':' .. field .. ':' .. old[i], job_id)
+        end
+        if new[i] then
+            redis.call('SADD', prefix .. ':' .. field .. ':' .. new[i], job_id)
+        end
+    end
+end
+
+-- state is the first indexed field
+local function update_stats(taxon, old, new)
+    if old[1] == new[1] then
+        return
+    end
+    if old[1] then
+        redis.call('HINCRBY', stats_key, taxon .. ':' .. old[1], -1)
+    end
+    if new[1] then
+        redis.call('HINCRBY', stats_key, taxon .. ':' .. new[1], 1)
+    end
+end
+
+-- jobs committed by VERSIONED classes count their writes, keep that up to date for script writes
+local function bump_revision(key)
+    if redis.call('HEXISTS', key, 'revision') == 1 then
+        redis.call('HINCRBY', key, 'revision', 1)
+    end
+end
+
+-- events are off if max_length is 0
+local function emit_event(max_length, job_id, taxon, old, new)
+    if max_length == '0' or old[1] == new[1] or not new[1] then
+        return
+    end
+    redis.call('XADD', events_key, 'MAXLEN', '~', max_length, '*',
+               'job_id', job_id, 'taxon', taxon, 'old_state', old[1] or '', 'new_state', new[1])
+end
+"""
+
+# KEYS: job key, ARGV: job ID, taxon, events max length, 1 for VERSIONED classes, field/value pairs to write
+_COMMIT_SCRIPT = LuaScript(_LUA_INDEXES + """
+local key, job_id, taxon = KEYS[1], ARGV[1], ARGV[2]
+local old = redis.call('HMGET', key, unpack(indexed))
+local ret = redis.call('HSET', key, unpack(ARGV, 5))
+-- VERSIONED classes start counting, others only count writes to jobs that have a revision
+if ARGV[4] == '1' then
+    redis.call('HINCRBY', key, 'revision', 1)
+else
+    bump_revision(key)
+end
+local new = redis.call('HMGET', key, unpack(indexed))
+update_indexes(job_id, old, new)
+update_stats(taxon, old, new)
+emit_event(ARGV[3], job_id, taxon, old, new)
+redis.call('SADD', prefix .. ':taxon:' .. taxon, job_id)
+return ret
+""")
+
+# KEYS: job key, trace list key, ARGV: job ID, taxon
+_DELETE_SCRIPT = LuaScript(_LUA_INDEXES + """
+local key, job_id, taxon = KEYS[1], ARGV[1], ARGV[2]
+local old = redis.call('HMGET', key, unpack(indexed))
+update_indexes(job_id, old, {})
+update_stats(taxon, old, {})
+redis.call('SREM', prefix .. ':taxon:' .. taxon, job_id)
+redis.call('DEL', KEYS[2])
+return redis.call('DEL', key)
+""")
+
+
+def index_key(field: str, value: str) -> str:
+    """Get the key of the secondary index set for a field value"""
+    return '{}:{}:{}'.format(INDEX_PREFIX, field, value)
+
+
+# SCAN patterns of all index sets, other keys under INDEX_PREFIX aren't ours to touch
+_INDEX_PATTERNS = tuple(index_key(field, '*') for field in INDEXED_FIELDS + ('taxon',))
+
 
 class BaseJob(BaseMapper):
     """An antiSMASH job as represented in the Redis DB"""
+    KEY_PREFIX = 'job'
     VALID_TAXA = {'bacteria', 'fungi', 'plant'}
 
     PROPERTIES = (
@@ -26,8 +127,12 @@ class BaseJob(BaseMapper):
 
     INTERNAL = (
         '_db',
+        '_dirty',
         '_id',
         '_key',
+        '_loaded',
+        '_raw',
+        '_revision',
         '_taxon',
         '_legacy',
     )
@@ -133,6 +238,12 @@ class BaseJob(BaseMapper):
         'trace',
     }
 
+    # approximate maximum length of the state change stream, 0 to not record state changes
+    EVENTS_MAX_LENGTH = 0
+
+    # maximum number of entries kept in the trace list, see append_trace
+    TRACE_MAX_LENGTH = 1000
+
     VALID_STATES = {
         'created',
         'downloading',
@@ -155,17 +266,9 @@ class BaseJob(BaseMapper):
     SAFE_ACCESSION_CHARS = string.ascii_letters + string.digits + "._-"
 
     def __init__(self, db: DataBase, job_id: str) -> None:
-        super(BaseJob, self).__init__(db, 'job:{}'.format(job_id))
+        super(BaseJob, self).__init__(db, '{}:{}'.format(self.KEY_PREFIX, job_id))
         self._id: str = job_id
-
-        # taxon is the first element of the ID
-        self._taxon: str = self._id.split('-')[0]
-        self._legacy: bool = False
-
-        # unless this is a legacy job id
-        if not self.is_valid_taxon(self._taxon) and job_id.count('-') == 4:
-            self._taxon = 'bacteria'
-            self._legacy = True
+        self._taxon, self._legacy = self._parse_id(job_id)
 
         # storage for properties
         self._state: str = 'created'
@@ -324,6 +427,16 @@ class BaseJob(BaseMapper):
 
         self._sideload_simple = value
 
+    @classmethod
+    def _parse_id(cls, job_id: str) -> tuple[str, bool]:
+        """Get the taxon of a job ID and whether it is a legacy ID"""
+        # taxon is the first element of the ID
+        taxon = job_id.split('-')[0]
+        # unless this is a legacy job id
+        if not cls.is_valid_taxon(taxon) and job_id.count('-') == 4:
+            return 'bacteria', True
+        return taxon, False
+
     @staticmethod
     def is_valid_taxon(taxon: str) -> bool:
         """
@@ -350,6 +463,170 @@ class BaseJob(BaseMapper):
     def __str__(self) -> str:
         return "Job(id: {}, state: {})".format(self._id, self.state)
 
+    def _queue_commit(self, pipe, full: bool = False) -> bool:
+        # write through a script, so the secondary indexes are updated atomically with the hash
+        self._invalidate()
+        mapping = self._changes(full)
+        if not mapping:
+            return False
+        args: list[Any] = [self._id, self._taxon, self.EVENTS_MAX_LENGTH, int(self.VERSIONED)]
+        for item in mapping.items():
+            args.extend(item)
+        _COMMIT_SCRIPT.queue(pipe, [self._key], *args)
+        return True
+
+    def _queue_delete(self, pipe) -> None:
+        # remove the job from the secondary indexes in the same step
+        self._invalidate()
+        _DELETE_SCRIPT.queue(pipe, [self._key, self.trace_key], self._id, self._taxon)
+
+    @property
+    def trace_key(self) -> str:
+        """Key of the list holding the entries added by append_trace"""
+        return '{}:trace'.format(self._key)
+
+    def _queue_append_trace(self, pipe, entries: tuple[str, ...]) -> None:
+        """Queue adding entries to the trace list, dropping the oldest ones past TRACE_MAX_LENGTH"""
+        if not entries:
+            raise ValueError("Need at least one trace entry to append")
+        pipe.rpush(self.trace_key, *entries)
+        pipe.ltrim(self.trace_key, -self.TRACE_MAX_LENGTH, -1)
+
+    def _queue_fetch_trace(self, pipe) -> None:
+        """Queue reading both the legacy JSON trace field and the trace list"""
+        pipe.hget(self._key, 'trace')
+        pipe.lrange(self.trace_key, 0, -1)
+
+    @staticmethod
+    def _merge_trace(legacy: Optional[str], entries: list[str]) -> list[str]:
+        """Combine the legacy JSON trace field and the trace list, oldest entries first"""
+        trace = json.loads(legacy) if legacy else []
+        trace.extend(entries)
+        return trace
+
+    @classmethod
+    def _index_keys(cls, criteria: dict[str, str]) -> list[str]:
+        """Get the index keys to intersect for a query"""
+        if not criteria:
+            raise ValueError("Need at least one of {} to find jobs".format(", ".join(INDEXED_FIELDS + ('taxon',))))
+        for name in criteria:
+            if name not in INDEXED_FIELDS and name != 'taxon':
+                raise ValueError("Jobs are not indexed on {}".format(name))
+        return [index_key(name, value) for name, value in criteria.items()]
+
+    @classmethod
+    def _queue_claim(cls, pipe, queues: Union[str, Iterable[str]], dispatcher: str) -> None:
+        """Queue the script claiming the next job from the first non-empty queue"""
+        if isinstance(queues, str):
+            queues = [queues]
+        queues = list(queues)
+        if not queues:
+            raise ValueError("Need at least one queue to claim a job from")
+        timestamp = now()
+        _CLAIM_SCRIPT.queue(pipe, queues, cls.KEY_PREFIX, dispatcher, _encode_date(timestamp),
+                            to_timestamp(timestamp) + CONTROL_TIMEOUT, cls.EVENTS_MAX_LENGTH,
+                            *cls._stored_args(cls.PROPERTIES + cls.ATTRIBUTES))
+
+    @classmethod
+    def _queue_reap(cls, pipe, action: str) -> None:
+        """Queue the script reaping the running jobs of dispatchers with a lapsed lease"""
+        if action not in ('requeue', 'fail'):
+            raise ValueError("Invalid reap action: {}".format(action))
+        timestamp = now()
+        _REAP_SCRIPT.queue(pipe, [], cls.KEY_PREFIX, to_timestamp(timestamp), action,
+                           'failed: dispatcher lease expired', _encode_date(timestamp), cls.EVENTS_MAX_LENGTH)
+
+    @classmethod
+    def _queue_clone(cls, pipe, db: DataBase, ids: list[tuple[str, str]], overrides: dict[str, Any],
+                     batch_size: int) -> None:
+        """Queue the scripts cloning jobs, batch_size pairs per script call"""
+        unknown = set(overrides) - cls._FIELDS
+        if unknown:
+            raise ValueError("Unknown {} fields: {}".format(cls.__name__, ", ".join(sorted(unknown))))
+        # None removes the field, anything else is validated and encoded the same way as assigning it on a job
+        unset = [name for name, value in overrides.items() if value is None]
+        scratch = cls._from_id(db, 'scratch')
+        for name, value in overrides.items():
+            if value is not None:
+                setattr(scratch, name, value)
+        encoded = scratch._serialise(tuple(name for name in overrides if name not in unset))
+        args: list[Any] = [len(encoded)]
+        for item in encoded.items():
+            args.extend(item)
+        args.append(len(unset))
+        args.extend(unset)
+        for i in range(0, len(ids), batch_size):
+            pairs = [job_id for pair in ids[i:i + batch_size] for job_id in pair]
+            _CLONE_SCRIPT.queue(pipe, [], cls.KEY_PREFIX, cls.EVENTS_MAX_LENGTH, *args, *pairs)
+
+    @classmethod
+    def _hydrate_claimed(cls: Type[TJob], db: DataBase, result: Optional[list[Any]]) -> Optional[TJob]:
+        """Create the job returned by the claim script"""
+        if result is None:
+            return None
+        job_id, values = result
+        job = cls._from_id(db, job_id)
+        job._invalidate()
+        job._load(cls.PROPERTIES + cls.ATTRIBUTES, values)
+        return job
+
+    @staticmethod
+    def _parse_stats(raw: dict[str, str]) -> dict[str, dict[str, int]]:
+        """Turn the stats hash into a mapping of taxon to state to job count"""
+        stats: dict[str, dict[str, int]] = {}
+        for field, count in raw.items():
+            taxon, state = field.rsplit(':', 1)
+            stats.setdefault(taxon, {})[state] = int(count)
+        return stats
+
+    @classmethod
+    def _count_states(cls, stats: dict[str, dict[str, int]], batch: list[tuple[str, list[Optional[str]]]]) -> None:
+        """Add jobs to a taxon to state to job count mapping, the same way the scripts count them
+
+        :param batch: Job IDs and their stored state, jobs without one aren't counted
+        """
+        for job_id, (state,) in batch:
+            if state is None:
+                continue
+            by_state = stats.setdefault(cls._parse_id(job_id)[0], {})
+            by_state[state] = by_state.get(state, 0) + 1
+
+    @staticmethod
+    def _queue_stats(pipe, stats: dict[str, dict[str, int]]) -> None:
+        """Queue replacing the stored stats"""
+        pipe.delete(STATS_KEY)
+        mapping = {'{}:{}'.format(taxon, state): count
+                   for taxon, by_state in stats.items() for state, count in by_state.items()}
+        if mapping:
+            pipe.hset(STATS_KEY, mapping=mapping)
+
+    @classmethod
+    def _queue_index(cls, pipe, batch: list[tuple[str, list[Optional[str]]]]) -> None:
+        """Queue adding already stored jobs to the indexes
+
+        :param batch: Job IDs and their stored values of INDEXED_FIELDS, indexed as is like the scripts do
+        """
+        for job_id, values in batch:
+            pipe.sadd(index_key('taxon', cls._parse_id(job_id)[0]), job_id)
+            for field, value in zip(INDEXED_FIELDS, values):
+                if value is not None:
+                    pipe.sadd(index_key(field, value), job_id)
+
+    @staticmethod
+    def _queue_fetch_stored(pipe, keys: list[str], fields: tuple[str, ...]) -> None:
+        """Queue reading the raw values of some fields for a batch of job keys"""
+        for key in keys:
+            pipe.hmget(key, *fields)
+
+    @classmethod
+    def _state_set(cls, states: Union[str, Iterable[str]]) -> set[str]:
+        """Get a set of valid states from a single state or an iterable of them"""
+        states = {states} if isinstance(states, str) else set(states)
+        for state in states:
+            if state not in cls.VALID_STATES:
+                raise ValueError("Invalid state {}".format(state))
+        return states
+
     @classmethod
     def fromExisting(cls: Type[TJob], new_id: str, existing: TJob) -> TJob:
         """"Create a copy from an existing job, with a new ID
@@ -363,13 +640,487 @@ class BaseJob(BaseMapper):
         return new
 
 
-@async_mixin
+# Lua snippet shared by the scripts that only get job IDs, derives the taxon and knows the dispatcher leases.
+# These scripts build the job keys from the IDs they find, so they declare none of them in KEYS.
+_LUA_JOBS = _LUA_INDEXES + """
+local leases_key = '""" + LEASES_KEY + """'
+local valid_taxa = {""" + ", ".join("{}=true".format(taxon) for taxon in sorted(BaseJob.VALID_TAXA)) + """}
+
+-- same rules as BaseJob.__init__
+local function job_taxon(job_id)
+    local taxon = string.match(job_id, '^[^-]*')
+    local _, dashes = string.gsub(job_id, '-', '')
+    if not valid_taxa[taxon] and dashes == 4 then
+        return 'bacteria'
+    end
+    return taxon
+end
+"""
+
+# KEYS: queues to try in order,
+# ARGV: job key prefix, dispatcher, last_changed, lease expiry, events max length, fields to return
+# Pops job IDs until it finds one that still exists, marks that job as running on the dispatcher
+# and returns its ID and field values, or nil if all queues are empty.
+# Dispatchers without a lease get one, so their jobs are reaped even if they never heartbeat,
+# and lapsed leases are renewed, so the job isn't reaped right after being claimed.
+_CLAIM_SCRIPT = LuaScript(_LUA_JOBS + """
+local key_prefix, dispatcher, changed, lease = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+for _, queue in ipairs(KEYS) do
+    local job_id = redis.call('RPOP', queue)
+    while job_id do
+        local key = key_prefix .. ':' .. job_id
+        if redis.call('EXISTS', key) == 1 then
+            local old = redis.call('HMGET', key, unpack(indexed))
+            redis.call('HSET', key, 'state', 'running', 'dispatcher', dispatcher, 'last_changed', changed)
+            bump_revision(key)
+            local new = redis.call('HMGET', key, unpack(indexed))
+            update_indexes(job_id, old, new)
+            update_stats(job_taxon(job_id), old, new)
+            emit_event(ARGV[5], job_id, job_taxon(job_id), old, new)
+            redis.call('ZADD', leases_key, 'GT', lease, dispatcher)
+            return {job_id, redis.call('HMGET', key, unpack(ARGV, 6))}
+        end
+        -- skip IDs of jobs deleted while queued
+        job_id = redis.call('RPOP', queue)
+    end
+end
+return nil
+""")
+
+# KEYS: none, ARGV: job key prefix, current timestamp, action, status, last_changed, events max length
+# Finds the dispatchers whose lease lapsed and moves their running jobs back to the first of their
+# target_queues ("requeue", failing jobs without one) or to failed ("fail"), then drops the leases.
+# Returns the IDs of the reaped jobs.
+_REAP_SCRIPT = LuaScript(_LUA_JOBS + """
+local key_prefix, timestamp, action, status, changed = ARGV[1], ARGV[2], ARGV[3], ARGV[4], ARGV[5]
+local reaped = {}
+for _, dispatcher in ipairs(redis.call('ZRANGEBYSCORE', leases_key, '-inf', timestamp)) do
+    local running = redis.call('SINTER', prefix .. ':state:running', prefix .. ':dispatcher:' .. dispatcher)
+    for _, job_id in ipairs(running) do
+        local key = key_prefix .. ':' .. job_id
+        local queue = nil
+        if action == 'requeue' then
+            local queues = redis.call('HGET', key, 'target_queues')
+            if queues then
+                queue = cjson.decode(queues)[1]
+            end
+        end
+        local old = redis.call('HMGET', key, unpack(indexed))
+        if queue then
+            redis.call('HSET', key, 'state', 'queued', 'last_changed', changed)
+            redis.call('HDEL', key, 'dispatcher')
+        else
+            redis.call('HSET', key, 'state', 'failed', 'status', status, 'last_changed', changed)
+        end
+        bump_revision(key)
+        local new = redis.call('HMGET', key, unpack(indexed))
+        update_indexes(job_id, old, new)
+        update_stats(job_taxon(job_id), old, new)
+        emit_event(ARGV[6], job_id, job_taxon(job_id), old, new)
+        if queue then
+            redis.call('LPUSH', queue, job_id)
+        end
+        reaped[#reaped + 1] = job_id
+    end
+    redis.call('ZREM', leases_key, dispatcher)
+end
+return reaped
+""")
+
+# KEYS: none, ARGV: job key prefix, events max length, number of fields to set, field/value pairs to set,
+# number of fields to delete, fields to delete, then source/target job ID pairs
+# Copies each source job hash to its target server-side, applies the overrides and original_id,
+# and indexes and counts the new job. Returns 1 per cloned pair, 0 if the source is missing or the target exists.
+_CLONE_SCRIPT = LuaScript(_LUA_JOBS + """
+local key_prefix, max_length = ARGV[1], ARGV[2]
+local unset_at = 4 + 2 * tonumber(ARGV[3])
+local set = {unpack(ARGV, 4, unset_at - 1)}
+local num_unset = tonumber(ARGV[unset_at])
+local unset = {unpack(ARGV, unset_at + 1, unset_at + num_unset)}
+local ret = {}
+for i = unset_at + num_unset + 1, #ARGV, 2 do
+    local source_id, job_id = ARGV[i], ARGV[i + 1]
+    local key = key_prefix .. ':' .. job_id
+    if redis.call('COPY', key_prefix .. ':' .. source_id, key) == 1 then
+        redis.call('HSET', key, 'original_id', source_id, unpack(set))
+        if #unset > 0 then
+            redis.call('HDEL', key, unpack(unset))
+        end
+        -- the clone is a new object as far as optimistic concurrency goes
+        if redis.call('HEXISTS', key, 'revision') == 1 then
+            redis.call('HSET', key, 'revision', 1)
+        end
+        local taxon = job_taxon(job_id)
+        local new = redis.call('HMGET', key, unpack(indexed))
+        update_indexes(job_id, {}, new)
+        update_stats(taxon, {}, new)
+        emit_event(max_length, job_id, taxon, {}, new)
+        redis.call('SADD', prefix .. ':taxon:' .. taxon, job_id)
+        table.insert(ret, 1)
+    else
+        table.insert(ret, 0)
+    end
+end
+return ret
+""")
+
+
+def indexed_async_mixin(klass):
+    """Extend async_mixin with index maintenance and queries"""
+    async def find(cls, db, fields: Optional[Iterable[str]] = None, **criteria: str):
+        """Find jobs by intersecting the secondary indexes
+
+        :param db: Database connection to use
+        :param fields: Only fetch these fields of the jobs found
+        :param criteria: Values to look for, any of state, dispatcher, jobtype and taxon
+        :return: List of matching jobs, sorted by ID
+        """
+        ids = await db.sinter(cls._index_keys(criteria))
+        jobs = await cls.fetch_many(db, sorted(ids), fields)
+        return [job for job in jobs if job is not None]
+
+    async def reindex(cls, db, batch_size: int = 100) -> int:
+        """Rebuild the secondary indexes from the stored jobs
+
+        Not atomic, jobs committed while this runs might be missing from the indexes.
+
+        :param db: Database connection to use
+        :param batch_size: Number of keys handled per round trip
+        :return: Number of jobs indexed
+        """
+        stale = [key for pattern in _INDEX_PATTERNS
+                 async for key in db.scan_iter(match=pattern, count=batch_size, _type='set')]
+        for keys in batched(stale, batch_size):
+            await db.delete(*keys)
+
+        count = 0
+        async for batch in cls._iter_stored(db, INDEXED_FIELDS, batch_size):
+            pipe = db.pipeline(transaction=False)
+            cls._queue_index(pipe, batch)
+            await pipe.execute()
+            count += len(batch)
+        return count
+
+    async def _iter_stored(cls, db, fields: tuple[str, ...], batch_size: int):
+        """Iterate over the stored values of all jobs in batches, without decoding them
+
+        :return: Async generator of lists of job ID and raw values of the fields
+        """
+        keys = db.scan_iter(match="{}:*".format(cls.KEY_PREFIX), count=batch_size, _type="hash")
+        async for batch in async_batched(keys, batch_size):
+            pipe = db.pipeline(transaction=False)
+            cls._queue_fetch_stored(pipe, batch, fields)
+            yield list(zip(cls._ids_from_keys(batch), await pipe.execute()))
+
+    async def claim(cls, db, queues: Union[str, Iterable[str]], dispatcher: str):
+        """Atomically take the next job off a queue and mark it as running
+
+        Jobs are expected to be LPUSHed onto the queues, the oldest one is claimed first.
+        Popping the ID, setting state, dispatcher and last_changed and updating the indexes
+        happens in a single script, so two dispatchers can never claim the same job.
+
+        :param db: Database connection to use
+        :param queues: Queue, or queues to try in order, e.g. the job's target_queues
+        :param dispatcher: Name of the dispatcher claiming the job
+        :return: The claimed job, or None if all queues are empty
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_claim(pipe, queues, dispatcher)
+        return cls._hydrate_claimed(db, (await async_execute(pipe))[0])
+
+    async def reap(cls, db, action: str = 'requeue') -> list[str]:
+        """Take back the running jobs of dispatchers that stopped renewing their lease
+
+        Leases are renewed by the dispatcher's control commit() and alive() calls, and taken out by claim().
+        Finding the jobs through the indexes, updating them and dropping the lapsed leases happens in a
+        single script.
+
+        :param db: Database connection to use
+        :param action: "requeue" to push the jobs back onto their first target queue, or "fail"
+        :return: IDs of the reaped jobs
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_reap(pipe, action)
+        return (await async_execute(pipe))[0]
+
+    async def append_trace(self, *entries: str) -> None:
+        """Append entries to the job's trace list in O(1), without rewriting the job hash
+
+        The list is capped at TRACE_MAX_LENGTH entries, dropping the oldest ones.
+
+        :param entries: Trace entries to add
+        """
+        pipe = self._db.pipeline(transaction=True)
+        self._queue_append_trace(pipe, entries)
+        await pipe.execute()
+
+    async def fetch_trace(self) -> list[str]:
+        """Get the full trace, including entries still stored in the legacy trace field
+
+        :return: Trace entries, oldest first
+        """
+        pipe = self._db.pipeline(transaction=False)
+        self._queue_fetch_trace(pipe)
+        return self._merge_trace(*(await pipe.execute()))
+
+    async def wait_for_change(self, timeout: float) -> bool:
+        """Wait for the job to be changed by anyone, then fetch it
+
+        Driven by keyspace notifications through a subscription shared by all waiting jobs,
+        so notify-keyspace-events needs to include at least "Kh".
+
+        :param timeout: Maximum number of seconds to wait
+        :return: True if the job changed and was fetched again, False on timeout
+        """
+        return await KeyWatcher.fetch_until(self, lambda job: True, timeout, fetch_first=False)
+
+    async def wait_for_state(self, states: Union[str, Iterable[str]], timeout: float) -> bool:
+        """Wait for the job to reach one of the given states, fetching it on every change
+
+        See wait_for_change for the server requirements.
+
+        :param states: State, or states to wait for, e.g. {'done', 'failed'}
+        :param timeout: Maximum number of seconds to wait
+        :return: True if the job is in one of the states, False on timeout
+        """
+        states = self._state_set(states)
+        return await KeyWatcher.fetch_until(self, lambda job: job.state in states, timeout)
+
+    async def clone_many(cls, db, ids: Union[dict[str, str], Iterable[tuple[str, str]]], batch_size: int = 100,
+                         **overrides: Any) -> list[bool]:
+        """Copy jobs server-side, e.g. to resubmit failed jobs in bulk
+
+        Hashes are duplicated with COPY in a script that also applies the overrides, sets original_id
+        to the source job ID and updates the indexes and counters, so nothing is decoded client-side.
+        The trace list isn't copied.
+
+        :param db: Database connection to use
+        :param ids: Mapping or pairs of source job ID to new job ID
+        :param batch_size: Number of jobs cloned per script call, all calls are sent in one round trip
+        :param overrides: Fields to change on the clones, e.g. state='queued', None to remove a field
+        :return: Per pair, True if the job was cloned, False if the source is missing or the target exists
+        """
+        pairs = list(ids.items() if isinstance(ids, dict) else ids)
+        if not pairs:
+            return []
+        pipe = db.pipeline(transaction=False)
+        cls._queue_clone(pipe, db, pairs, overrides, batch_size)
+        return [bool(res) for batch in (await async_execute(pipe)) for res in batch]
+
+    async def job_stats(cls, db) -> dict[str, dict[str, int]]:
+        """Get the number of jobs per taxon and state in a single call
+
+        Counters are maintained by commits and deletes, see reconcile_stats to rebuild them.
+
+        :param db: Database connection to use
+        :return: Mapping of taxon to state to job count
+        """
+        return cls._parse_stats(await db.hgetall(STATS_KEY))
+
+    async def reconcile_stats(cls, db, batch_size: int = 100) -> dict[str, dict[str, int]]:
+        """Recompute the job counters from a scan over all stored jobs
+
+        Not atomic, jobs committed while this runs might be miscounted.
+
+        :param db: Database connection to use
+        :param batch_size: Number of jobs fetched per round trip
+        :return: The new mapping of taxon to state to job count
+        """
+        stats: dict[str, dict[str, int]] = {}
+        async for batch in cls._iter_stored(db, ('state',), batch_size):
+            cls._count_states(stats, batch)
+
+        pipe = db.pipeline(transaction=True)
+        cls._queue_stats(pipe, stats)
+        await pipe.execute()
+        return stats
+
+    klass = async_mixin(klass)
+    klass.claim = classmethod(claim)
+    klass.reap = classmethod(reap)
+    klass.clone_many = classmethod(clone_many)
+    klass.append_trace = append_trace
+    klass.fetch_trace = fetch_trace
+    klass.wait_for_change = wait_for_change
+    klass.wait_for_state = wait_for_state
+    klass.job_stats = classmethod(job_stats)
+    klass.reconcile_stats = classmethod(reconcile_stats)
+    klass.find = classmethod(find)
+    klass.reindex = classmethod(reindex)
+    klass._iter_stored = classmethod(_iter_stored)
+
+    return klass
+
+
+def indexed_sync_mixin(klass):
+    """Extend sync_mixin with index maintenance and queries"""
+    def find(cls, db, fields: Optional[Iterable[str]] = None, **criteria: str):
+        """Find jobs by intersecting the secondary indexes
+
+        :param db: Database connection to use
+        :param fields: Only fetch these fields of the jobs found
+        :param criteria: Values to look for, any of state, dispatcher, jobtype and taxon
+        :return: List of matching jobs, sorted by ID
+        """
+        ids = db.sinter(cls._index_keys(criteria))
+        jobs = cls.fetch_many(db, sorted(ids), fields)
+        return [job for job in jobs if job is not None]
+
+    def reindex(cls, db, batch_size: int = 100) -> int:
+        """Rebuild the secondary indexes from the stored jobs
+
+        Not atomic, jobs committed while this runs might be missing from the indexes.
+
+        :param db: Database connection to use
+        :param batch_size: Number of keys handled per round trip
+        :return: Number of jobs indexed
+        """
+        stale = [key for pattern in _INDEX_PATTERNS
+                 for key in db.scan_iter(match=pattern, count=batch_size, _type='set')]
+        for keys in batched(stale, batch_size):
+            db.delete(*keys)
+
+        count = 0
+        for batch in cls._iter_stored(db, INDEXED_FIELDS, batch_size):
+            pipe = db.pipeline(transaction=False)
+            cls._queue_index(pipe, batch)
+            pipe.execute()
+            count += len(batch)
+        return count
+
+    def _iter_stored(cls, db, fields: tuple[str, ...], batch_size: int):
+        """Iterate over the stored values of all jobs in batches, without decoding them
+
+        :return: Generator of lists of job ID and raw values of the fields
+        """
+        keys = db.scan_iter(match="{}:*".format(cls.KEY_PREFIX), count=batch_size, _type="hash")
+        for batch in batched(keys, batch_size):
+            pipe = db.pipeline(transaction=False)
+            cls._queue_fetch_stored(pipe, batch, fields)
+            yield list(zip(cls._ids_from_keys(batch), pipe.execute()))
+
+    def claim(cls, db, queues: Union[str, Iterable[str]], dispatcher: str):
+        """Atomically take the next job off a queue and mark it as running
+
+        Jobs are expected to be LPUSHed onto the queues, the oldest one is claimed first.
+        Popping the ID, setting state, dispatcher and last_changed and updating the indexes
+        happens in a single script, so two dispatchers can never claim the same job.
+
+        :param db: Database connection to use
+        :param queues: Queue, or queues to try in order, e.g. the job's target_queues
+        :param dispatcher: Name of the dispatcher claiming the job
+        :return: The claimed job, or None if all queues are empty
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_claim(pipe, queues, dispatcher)
+        return cls._hydrate_claimed(db, execute(pipe)[0])
+
+    def reap(cls, db, action: str = 'requeue') -> list[str]:
+        """Take back the running jobs of dispatchers that stopped renewing their lease
+
+        Leases are renewed by the dispatcher's control commit() and alive() calls, and taken out by claim().
+        Finding the jobs through the indexes, updating them and dropping the lapsed leases happens in a
+        single script.
+
+        :param db: Database connection to use
+        :param action: "requeue" to push the jobs back onto their first target queue, or "fail"
+        :return: IDs of the reaped jobs
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_reap(pipe, action)
+        return execute(pipe)[0]
+
+    def append_trace(self, *entries: str) -> None:
+        """Append entries to the job's trace list in O(1), without rewriting the job hash
+
+        The list is capped at TRACE_MAX_LENGTH entries, dropping the oldest ones.
+
+        :param entries: Trace entries to add
+        """
+        pipe = self._db.pipeline(transaction=True)
+        self._queue_append_trace(pipe, entries)
+        pipe.execute()
+
+    def fetch_trace(self) -> list[str]:
+        """Get the full trace, including entries still stored in the legacy trace field
+
+        :return: Trace entries, oldest first
+        """
+        pipe = self._db.pipeline(transaction=False)
+        self._queue_fetch_trace(pipe)
+        return self._merge_trace(*pipe.execute())
+
+    def clone_many(cls, db, ids: Union[dict[str, str], Iterable[tuple[str, str]]], batch_size: int = 100,
+                   **overrides: Any) -> list[bool]:
+        """Copy jobs server-side, e.g. to resubmit failed jobs in bulk
+
+        Hashes are duplicated with COPY in a script that also applies the overrides, sets original_id
+        to the source job ID and updates the indexes and counters, so nothing is decoded client-side.
+        The trace list isn't copied.
+
+        :param db: Database connection to use
+        :param ids: Mapping or pairs of source job ID to new job ID
+        :param batch_size: Number of jobs cloned per script call, all calls are sent in one round trip
+        :param overrides: Fields to change on the clones, e.g. state='queued', None to remove a field
+        :return: Per pair, True if the job was cloned, False if the source is missing or the target exists
+        """
+        pairs = list(ids.items() if isinstance(ids, dict) else ids)
+        if not pairs:
+            return []
+        pipe = db.pipeline(transaction=False)
+        cls._queue_clone(pipe, db, pairs, overrides, batch_size)
+        return [bool(res) for batch in execute(pipe) for res in batch]
+
+    def job_stats(cls, db) -> dict[str, dict[str, int]]:
+        """Get the number of jobs per taxon and state in a single call
+
+        Counters are maintained by commits and deletes, see reconcile_stats to rebuild them.
+
+        :param db: Database connection to use
+        :return: Mapping of taxon to state to job count
+        """
+        return cls._parse_stats(db.hgetall(STATS_KEY))
+
+    def reconcile_stats(cls, db, batch_size: int = 100) -> dict[str, dict[str, int]]:
+        """Recompute the job counters from a scan over all stored jobs
+
+        Not atomic, jobs committed while this runs might be miscounted.
+
+        :param db: Database connection to use
+        :param batch_size: Number of jobs fetched per round trip
+        :return: The new mapping of taxon to state to job count
+        """
+        stats: dict[str, dict[str, int]] = {}
+        for batch in cls._iter_stored(db, ('state',), batch_size):
+            cls._count_states(stats, batch)
+
+        pipe = db.pipeline(transaction=True)
+        cls._queue_stats(pipe, stats)
+        pipe.execute()
+        return stats
+
+    klass = sync_mixin(klass)
+    klass.claim = classmethod(claim)
+    klass.reap = classmethod(reap)
+    klass.clone_many = classmethod(clone_many)
+    klass.append_trace = append_trace
+    klass.fetch_trace = fetch_trace
+    klass.job_stats = classmethod(job_stats)
+    klass.reconcile_stats = classmethod(reconcile_stats)
+    klass.find = classmethod(find)
+    klass.reindex = classmethod(reindex)
+    klass._iter_stored = classmethod(_iter_stored)
+
+    return klass
+
+
+@indexed_async_mixin
 class AsyncJob(BaseJob):
     """Job using fetch/commit as co-routines"""
     __slots__ = ()
 
 
-@sync_mixin
+@indexed_sync_mixin
 class SyncJob(BaseJob):
     """Job using sync fetch/commit functions"""
     __slots__ = ()
@@ -1,18 +1,44 @@
 """antiSMASH notice abstraction"""
 from __future__ import annotations
 from datetime import datetime, timedelta
-from functools import wraps
-from typing import TypeVar, Union
+from typing import Any, Optional, Type, TypeVar, Union
 
 from .base import BaseMapper, DataBase, async_mixin, sync_mixin
-from .utils import now
+from .scripts import LuaScript, async_execute, execute
+from .utils import now, to_timestamp
 
 TNotice = TypeVar("TNotice", bound="BaseNotice")
 
+# sorted sets of notice IDs, scored by the timestamps of show_from and show_until
+SHOW_FROM_KEY = 'notices:show_from'
+SHOW_UNTIL_KEY = 'notices:show_until'
+
+# KEYS: show_from index, show_until index, ARGV: current timestamp, key prefix, fields to fetch
+# Returns notice ID and field values for every notice currently shown, pruning expired ones on the way.
+# The notice keys are built from the IDs in the indexes, see the scripts module.
+_ACTIVE_SCRIPT = LuaScript("""
+local now, prefix = ARGV[1], ARGV[2]
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+local ret = {}
+for _, notice_id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now)) do
+    local key = prefix .. ':' .. notice_id
+    if redis.call('ZSCORE', KEYS[2], notice_id) and redis.call('EXISTS', key) == 1 then
+        table.insert(ret, notice_id)
+        table.insert(ret, redis.call('HMGET', key, unpack(ARGV, 3)))
+    else
+        redis.call('ZREM', KEYS[1], notice_id)
+        redis.call('ZREM', KEYS[2], notice_id)
+    end
+end
+return ret
+""")
+
 
 class BaseNotice(BaseMapper):
     """Notice object"""
 
+    KEY_PREFIX = 'notice'
+
     PROPERTIES = (
         'category',
     )
@@ -27,8 +53,12 @@ class BaseNotice(BaseMapper):
 
     INTERNAL = (
         '_db',
+        '_dirty',
         '_id',
         '_key',
+        '_loaded',
+        '_raw',
+        '_revision',
     )
 
     # Meh, needs to be repeated if we want to allow subclasses to have restricted attributes
@@ -49,7 +79,7 @@ class BaseNotice(BaseMapper):
                  teaser: str = "placeholder", text: str = "placeholder",
                  show_from: Union[datetime, None] = None,
                  show_until: Union[datetime, None] = None):
-        super(BaseNotice, self).__init__(db, "notice:{}".format(notice_id))
+        super(BaseNotice, self).__init__(db, "{}:{}".format(self.KEY_PREFIX, notice_id))
         self._id: str = notice_id
         self.category = category
 
@@ -75,40 +105,106 @@ class BaseNotice(BaseMapper):
             raise ValueError("Invalid category {!r}".format(val))
         self._category = val
 
+    def _has_value(self, name: str) -> bool:
+        """False if a field was left out of a partial fetch and not assigned since, so it only has its default"""
+        return self._loaded is None or name in self._loaded or bool(self._dirty and name in self._dirty)
+
+    def _queue_commit(self, pipe, full: bool = False) -> bool:
+        wrote = super(BaseNotice, self)._queue_commit(pipe, full)
+        # keep the notice in the indexes used to find active notices, unless only the default is known
+        if self._has_value('show_from'):
+            pipe.zadd(SHOW_FROM_KEY, {self._id: to_timestamp(self.show_from)})
+        if self._has_value('show_until'):
+            pipe.zadd(SHOW_UNTIL_KEY, {self._id: to_timestamp(self.show_until)})
+        return wrote
+
+    def _queue_delete(self, pipe) -> None:
+        super(BaseNotice, self)._queue_delete(pipe)
+        pipe.zrem(SHOW_FROM_KEY, self._id)
+        pipe.zrem(SHOW_UNTIL_KEY, self._id)
+
+    @classmethod
+    def _queue_active(cls, pipe) -> None:
+        """Queue the script finding all notices shown right now"""
+        _ACTIVE_SCRIPT.queue(pipe, [SHOW_FROM_KEY, SHOW_UNTIL_KEY], to_timestamp(now()), cls.KEY_PREFIX,
+                             *cls._stored_args(cls.PROPERTIES + cls.ATTRIBUTES))
+
+    @classmethod
+    def _hydrate_active(cls: Type[TNotice], db: DataBase, result: list[Any]) -> list[TNotice]:
+        """Create notices from the result of the active notices script"""
+        args = cls.PROPERTIES + cls.ATTRIBUTES
+        notices = []
+        for i in range(0, len(result), 2):
+            notice = cls._from_id(db, result[i])
+            notice._load(args, result[i + 1])
+            notices.append(notice)
+        return notices
+
+
+def _expiry(self) -> int:
+    """Seconds until the notice should expire"""
+    # expire on the difference instead of using expireat, fetched dates are naive UTC while now() may not be
+    return int(to_timestamp(self.show_until) - to_timestamp(now()))
+
+
+def _queue_expire(self, pipe) -> None:
+    # keep the stored expiry instead of computing one from the default show_until
+    if self._has_value('show_until'):
+        pipe.expire(self._key, _expiry(self))
+
 
 def expiring_async_mixin(klass):
     """Override async_mixin to expire the object"""
-    def commit_expire(fn):
-        @wraps(fn)
-        async def wrapper(self):
-            ret = await fn(self)
-            # aio-redis expireat can't deal with datetime objects, but converting datetimes to timestamps sucks,
-            # so use expire on the difference instead
-            td = self.show_until - now()
-            await self._db.expire(self._key, int(td.total_seconds()))
-            return ret
-        return wrapper
+    async def commit(self, full: bool = False, if_version: Optional[int] = None):
+        if if_version is not None:
+            return await self._commit_checked(full, if_version)
+        # HSET and EXPIRE go out in one transaction, so the key never exists without a TTL
+        pipe = self._db.pipeline(transaction=True)
+        wrote = self._queue_commit(pipe, full)
+        return self._commit_result(wrote, await async_execute(pipe))
+
+    async def active(cls, db):
+        """Get all notices shown right now, in a single round trip
+
+        :param db: Database connection to use
+        :return: List of notices ordered by show_from
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_active(pipe)
+        return cls._hydrate_active(db, (await async_execute(pipe))[0])
 
     klass = async_mixin(klass)
-    klass.commit = commit_expire(klass.commit)
+    klass.commit = commit
+    klass.active = classmethod(active)
+    klass._queue_expire = _queue_expire
 
     return klass
 
 
 def expiring_sync_mixin(klass):
     """Override the sync_mixin to expire the object"""
-    def commit_expire(fn):
-        @wraps(fn)
-        def wrapper(self):
-            ret = fn(self)
-            # regular redis doesn't deal with datetime objects anymore either, so also use expire on the difference
-            td = self.show_until - now()
-            self._db.expire(self._key, int(td.total_seconds()))
-            return ret
-        return wrapper
+    def commit(self, full: bool = False, if_version: Optional[int] = None):
+        if if_version is not None:
+            return self._commit_checked(full, if_version)
+        # HSET and EXPIRE go out in one transaction, so the key never exists without a TTL
+        pipe = self._db.pipeline(transaction=True)
+        wrote = self._queue_commit(pipe, full)
+        return self._commit_result(wrote, execute(pipe))
+
+    def active(cls, db):
+        """Get all notices shown right now, in a single round trip
+
+        :param db: Database connection to use
+        :return: List of notices ordered by show_from
+        """
+        pipe = db.pipeline(transaction=False)
+        cls._queue_active(pipe)
+        return cls._hydrate_active(db, execute(pipe)[0])
 
     klass = sync_mixin(klass)
-    klass.commit = commit_expire(klass.commit)
+    klass.commit = commit
+    klass.active = classmethod(active)
+    klass._queue_expire = _queue_expire
 
     return klass
 
@@ -0,0 +1,102 @@
+"""Lua scripts sent by their SHA1 hash instead of their full source
+
+The job, control and notice scripts derive some of the keys they touch from stored values, e.g. the
+index sets of a job's old state, so those keys can't be declared in KEYS. The scripts therefore only
+work on a single, non-cluster server.
+"""
+from __future__ import annotations
+from hashlib import sha1
+from typing import Any, Sequence
+
+from redis.exceptions import NoScriptError
+
+
+class LuaScript:
+    """Script queued as EVALSHA, loaded by execute/async_execute if the server doesn't know it yet"""
+
+    # all scripts by hash, to find the source of a script the server reported missing
+    _registry: dict[str, LuaScript] = {}
+
+    def __init__(self, script: str) -> None:
+        # pipelines load missing scripts from the script and sha attributes
+        self.script = script
+        self.sha = sha1(script.encode('utf-8')).hexdigest()
+        self._registry[self.sha] = self
+
+    def queue(self, pipe, keys: Sequence[str], *args: Any) -> None:
+        """Queue running the script on a pipeline
+
+        :param keys: Keys declared to the script
+        :param args: Arguments to the script
+        """
+        pipe.evalsha(self.sha, len(keys), *keys, *args)
+
+    @classmethod
+    def preload(cls, pipe) -> None:
+        """Make a pipeline load all missing scripts before it executes, for pipelines that can't be re-run"""
+        pipe.scripts.update(cls._registry.values())
+
+
+def _preload_queued(pipe) -> None:
+    """Make a transaction load the scripts it runs before executing, re-running them would leave the transaction"""
+    if pipe.transaction or pipe.explicit_transaction:
+        for args, _ in pipe.command_stack:
+            if args[0] == 'EVALSHA':
+                pipe.scripts.add(LuaScript._registry[args[1]])
+
+
+def _missing(results: list[Any]) -> list[int]:
+    """Get the indices of the commands that failed because the server didn't know the script"""
+    return [i for i, res in enumerate(results) if isinstance(res, NoScriptError)]
+
+
+def _requeue(pipe, stack: list[Any], missing: list[int]) -> None:
+    """Queue the failed script calls again, loading their scripts first"""
+    for i in missing:
+        args, options = stack[i]
+        pipe.pipeline_execute_command(*args, **options)
+        pipe.scripts.add(LuaScript._registry[args[1]])
+
+
+def _merge(results: list[Any], missing: list[int], retried: list[Any]) -> None:
+    """Replace the results of the failed script calls with those of the re-run"""
+    for i, res in zip(missing, retried):
+        results[i] = res
+
+
+def _raise_first_error(results: list[Any]) -> None:
+    for res in results:
+        if isinstance(res, Exception):
+            raise res
+
+
+def execute(pipe, raise_on_error: bool = True) -> list[Any]:
+    """Execute a pipeline, re-running script calls that failed because the server didn't know the script
+
+    Only the failed calls are re-run, after loading their scripts, e.g. after a server restart.
+    Transactions load their scripts up front instead, so all of their commands still run in one MULTI/EXEC.
+    """
+    _preload_queued(pipe)
+    stack = pipe.command_stack
+    results = pipe.execute(raise_on_error=False)
+    missing = _missing(results)
+    if missing:
+        _requeue(pipe, stack, missing)
+        _merge(results, missing, pipe.execute(raise_on_error=False))
+    if raise_on_error:
+        _raise_first_error(results)
+    return results
+
+
+async def async_execute(pipe, raise_on_error: bool = True) -> list[Any]:
+    """Execute an async pipeline, see execute"""
+    _preload_queued(pipe)
+    stack = pipe.command_stack
+    results = await pipe.execute(raise_on_error=False)
+    missing = _missing(results)
+    if missing:
+        _requeue(pipe, stack, missing)
+        _merge(results, missing, await pipe.execute(raise_on_error=False))
+    if raise_on_error:
+        _raise_first_error(results)
+    return results
@@ -0,0 +1,96 @@
+"""Unit of work batching the commits of several objects into one transaction"""
+from __future__ import annotations
+from typing import Any, Optional
+
+from redis import Redis as SyncRedis
+from redis.asyncio import Redis as AsyncRedis
+
+from .base import BaseMapper, DataBase
+from .scripts import async_execute, execute
+
+
+class BaseSession:
+    """Tracks objects to commit together in a single MULTI/EXEC round trip"""
+
+    _db: DataBase
+
+    def __init__(self, db: DataBase, full: bool = False) -> None:
+        self._db = db
+        self.full = full
+        self._objects: list[BaseMapper] = []
+        self._flushed: list[BaseMapper] = []
+        # per-object results of the last flush, exceptions for failed commits
+        self.results: Optional[list[Any]] = None
+
+    def add(self, *objects: BaseMapper) -> None:
+        """Track objects, adding an object more than once still commits it once"""
+        for obj in objects:
+            if not isinstance(obj, BaseMapper):
+                raise ValueError("Can't track {!r} in a session".format(obj))
+            if not any(obj is tracked for tracked in self._objects):
+                self._objects.append(obj)
+
+    def __len__(self) -> int:
+        return len(self._objects)
+
+    @property
+    def errors(self) -> list[tuple[BaseMapper, Exception]]:
+        """Objects that failed to commit in the last flush, with their error"""
+        return [(obj, res) for obj, res in zip(self._flushed, self.results or [])
+                if isinstance(res, Exception)]
+
+    def _queue(self, pipe) -> tuple[list[BaseMapper], list[tuple[int, bool]]]:
+        """Queue the commits, including expiry, of all tracked objects"""
+        objects = self._flushed = self._objects
+        self._objects = []
+        return objects, BaseMapper._queue_many(pipe, objects, self.full)
+
+
+class AsyncSession(BaseSession):
+    """Session for async objects, use as ``async with AsyncSession(db) as session``"""
+
+    _db: AsyncRedis
+
+    async def flush(self) -> list[Any]:
+        """Commit all tracked objects in one transaction and stop tracking them
+
+        :return: List of per-object results in the order the objects were added, exceptions for failed commits
+        """
+        pipe = self._db.pipeline(transaction=True)
+        objects, queued = self._queue(pipe)
+        results = await async_execute(pipe, raise_on_error=False) if len(pipe) else []
+        self.results = BaseMapper._split_results(objects, queued, results)
+        return self.results
+
+    async def __aenter__(self) -> AsyncSession:
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> None:
+        # nothing is written if the block raised
+        if exc_type is None:
+            await self.flush()
+
+
+class SyncSession(BaseSession):
+    """Session for sync objects, use as ``with SyncSession(db) as session``"""
+
+    _db: SyncRedis
+
+    def flush(self) -> list[Any]:
+        """Commit all tracked objects in one transaction and stop tracking them
+
+        :return: List of per-object results in the order the objects were added, exceptions for failed commits
+        """
+        pipe = self._db.pipeline(transaction=True)
+        objects, queued = self._queue(pipe)
+        results = execute(pipe, raise_on_error=False) if len(pipe) else []
+        self.results = BaseMapper._split_results(objects, queued, results)
+        return self.results
+
+    def __enter__(self) -> SyncSession:
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        # nothing is written if the block raised
+        if exc_type is None:
+            self.flush()
@@ -1,6 +1,9 @@
 """Utility functions used in multiple modules"""
 
-from datetime import datetime
+from datetime import datetime, timezone
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, TypeVar
+
+T = TypeVar("T")
 
 try:  # pragma: no cover
     from datetime import UTC  # type: ignore  # 3.10 and older don't have this
@@ -11,3 +14,41 @@ except ImportError:  # pragma: no cover
 
     def now():
         return datetime.utcnow()
+
+
+def to_timestamp(date: datetime) -> float:
+    """Get the POSIX timestamp of a datetime, treating naive datetimes as UTC"""
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def keyspace_key(channel) -> str:
+    """Get the key a keyspace notification channel of the form __keyspace@<db>__:<key> is about"""
+    if isinstance(channel, bytes):
+        channel = channel.decode()
+    return channel.partition(':')[2]
+
+
+def batched(items: Iterable[T], size: int) -> Iterator[list[T]]:
+    """Split items into lists of at most size items"""
+    batch: list[T] = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def async_batched(items: AsyncIterable[T], size: int) -> AsyncIterator[list[T]]:
+    """Split the items of an async iterable into lists of at most size items"""
+    batch: list[T] = []
+    async for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,144 @@
+"""Shared keyspace notification subscriber for coroutines waiting on key changes
+
+Needs keyspace notifications enabled on the server, e.g. ``CONFIG SET notify-keyspace-events Kghx``.
+"""
+from __future__ import annotations
+import asyncio
+from typing import Any, Callable, Optional
+from weakref import WeakKeyDictionary
+
+from redis.asyncio import Redis as AsyncRedis
+
+from .cache import ReadCache
+from .utils import keyspace_key
+
+
+class KeyWatcher:
+    """Wakes up waiting coroutines when the keys they watch change, using a single subscription"""
+
+    # one watcher per connection and prefix, see shared()
+    _shared: WeakKeyDictionary[AsyncRedis, dict[str, KeyWatcher]] = WeakKeyDictionary()
+    # held while starting a shared watcher, so concurrent callers don't start one each
+    _starting: WeakKeyDictionary[AsyncRedis, dict[str, asyncio.Lock]] = WeakKeyDictionary()
+
+    def __init__(self, db: AsyncRedis, prefix: str) -> None:
+        self._db = db
+        self.prefix = prefix
+        self._waiters: dict[str, set[asyncio.Event]] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    async def shared(cls, db: AsyncRedis, prefix: str) -> KeyWatcher:
+        """Get the running watcher for a connection and key prefix, starting it if needed"""
+        watchers = cls._shared.setdefault(db, {})
+        watcher = watchers.get(prefix)
+        if watcher is not None and watcher.running:
+            return watcher
+        async with cls._starting.setdefault(db, {}).setdefault(prefix, asyncio.Lock()):
+            # another caller might have started one while this one waited for the lock
+            watcher = watchers.get(prefix)
+            if watcher is None or not watcher.running:
+                watcher = cls(db, prefix)
+                await watcher.start()
+                watchers[prefix] = watcher
+        return watcher
+
+    @classmethod
+    async def fetch_until(cls, obj: Any, done: Callable[[Any], bool], timeout: float,
+                          fetch_first: bool = True) -> bool:
+        """Fetch an async mapper object on every change of its key until done returns True for it
+
+        :param obj: Object to watch, using the shared watcher of its connection and key prefix
+        :param done: Called with the object after every fetch
+        :param timeout: Maximum number of seconds to wait
+        :param fetch_first: If False, only fetch once the key changed for the first time
+        :return: True once done returned True, False on timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        watcher = await cls.shared(obj._db, obj.KEY_PREFIX)
+        event = watcher.watch(obj._key)
+        try:
+            if not fetch_first and not await watcher.wait(event, timeout):
+                return False
+            while True:
+                # clear before fetching, so changes made during the fetch aren't missed
+                event.clear()
+                await obj.fetch()
+                if done(obj):
+                    return True
+                if not await watcher.wait(event, deadline - loop.time()):
+                    return False
+                if not watcher.running:
+                    # the subscription was lost, resubscribe
+                    watcher.unwatch(obj._key, event)
+                    watcher = await cls.shared(obj._db, obj.KEY_PREFIX)
+                    event = watcher.watch(obj._key)
+        finally:
+            watcher.unwatch(obj._key, event)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """Subscribe and start dispatching notifications, changes are seen once this returns"""
+        if self.running:
+            return
+        pubsub = self._db.pubsub(ignore_subscribe_messages=True)
+        await pubsub.psubscribe(*ReadCache.patterns((self.prefix,)))
+        self._task = asyncio.create_task(self._run(pubsub))
+
+    async def stop(self) -> None:
+        """Unsubscribe, waking up all waiters"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self, pubsub) -> None:
+        try:
+            async for message in pubsub.listen():
+                if message['type'] != 'pmessage':
+                    continue
+                for event in self._waiters.get(keyspace_key(message['channel']), ()):
+                    event.set()
+        finally:
+            # let waiters re-check instead of hanging until their timeout
+            for events in self._waiters.values():
+                for event in events:
+                    event.set()
+            # redis-py 5.0.1 renamed reset to aclose
+            await getattr(pubsub, 'aclose', pubsub.reset)()
+
+    def watch(self, key: str) -> asyncio.Event:
+        """Get an event that is set on the next change of a key, pass it to unwatch when done"""
+        event = asyncio.Event()
+        self._waiters.setdefault(key, set()).add(event)
+        return event
+
+    @staticmethod
+    async def wait(event: asyncio.Event, timeout: float) -> bool:
+        """Wait for an event returned by watch
+
+        :param timeout: Maximum number of seconds to wait, the event is only checked if not positive
+        :return: True if the event was set, False on timeout
+        """
+        try:
+            await asyncio.wait_for(event.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def unwatch(self, key: str, event: asyncio.Event) -> None:
+        """Stop setting an event returned by watch"""
+        events = self._waiters.get(key)
+        if events is None:
+            return
+        events.discard(event)
+        if not events:
+            del self._waiters[key]
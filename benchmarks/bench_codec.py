@@ -0,0 +1,62 @@
+"""Benchmark serialising and hydrating BaseJob objects without a database
+
+Usage: python benchmarks/bench_codec.py [--jobs 100000] [--repeat 3]
+"""
+from __future__ import annotations
+import argparse
+import timeit
+
+from antismash_models.job import BaseJob
+
+
+def make_values(db) -> tuple[tuple[str, ...], list]:
+    job = BaseJob(db, "bacteria-benchmark")
+    job.state = "running"
+    job.status = "running: antiSMASH analysis"
+    job.dispatcher = "dispatcher-1"
+    job.target_queues = ["jobs:queued"]
+    job.trace = ["web", "dispatcher-1"]
+    job.tta = True
+    job.clusterblast = True
+    job.seed = 42
+    job.cf_threshold = 0.6
+    data = job.to_dict()
+    args = BaseJob.PROPERTIES + BaseJob.ATTRIBUTES
+    # values come back from redis as strings
+    return args, [None if data.get(arg) is None else str(data[arg]) for arg in args]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=100000, help="Number of jobs to hydrate")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the best one is reported")
+    args = parser.parse_args()
+
+    db = None
+    fields, values = make_values(db)
+
+    def hydrate() -> None:
+        for i in range(args.jobs):
+            job = BaseJob(db, "bacteria-{}".format(i))
+            job._parse(fields, values)
+
+    job = BaseJob(db, "bacteria-benchmark")
+    job._parse(fields, values)
+
+    def serialise() -> None:
+        for _ in range(args.jobs):
+            job.to_dict()
+
+    dates = [values[fields.index("added")], values[fields.index("last_changed")]]
+
+    def decode_dates() -> None:
+        for _ in range(args.jobs):
+            job._parse(("added", "last_changed"), dates)
+
+    for label, func in [("hydrate", hydrate), ("serialise", serialise), ("decode dates of", decode_dates)]:
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print("{} {} jobs: {:6.2f} s".format(label, args.jobs, best))
+
+
+if __name__ == "__main__":
+    main()
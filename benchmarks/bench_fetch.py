@@ -0,0 +1,61 @@
+"""Benchmark fetch latency against a running redis-server
+
+Compares the old two round trip fetch (EXISTS, then HMGET) with the current
+single round trip fetch, reporting p50/p99 latencies.
+
+Usage: python benchmarks/bench_fetch.py [--url redis://localhost:6379/15] [--rounds 10000]
+"""
+from __future__ import annotations
+import argparse
+import time
+
+from redis import Redis
+
+from antismash_models import SyncJob
+
+
+def percentile(timings: list[float], pct: float) -> float:
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100))]
+
+
+def fetch_two_round_trips(job: SyncJob) -> None:
+    args = job.PROPERTIES + job.ATTRIBUTES
+    if job._db.exists(job._key) == 0:
+        raise ValueError("missing")
+    job._parse(args, job._db.hmget(job._key, *args))
+
+
+def fetch_one_round_trip(job: SyncJob) -> None:
+    job.fetch()
+
+
+def run(label: str, func, job: SyncJob, rounds: int) -> None:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(job)
+        timings.append((time.perf_counter() - start) * 1e6)
+    print("{:<20} p50: {:8.1f} µs   p99: {:8.1f} µs".format(label, percentile(timings, 50), percentile(timings, 99)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="redis://localhost:6379/15", help="Redis server to run against")
+    parser.add_argument("--rounds", type=int, default=10000, help="Number of fetches per variant")
+    args = parser.parse_args()
+
+    db = Redis.from_url(args.url, encoding="utf-8", decode_responses=True)
+    job = SyncJob(db, "bacteria-benchmark")
+    job.trace.append("benchmark")
+    job.commit()
+
+    try:
+        run("exists + hmget", fetch_two_round_trips, job, args.rounds)
+        run("pipelined fetch", fetch_one_round_trip, job, args.rounds)
+    finally:
+        job.delete()
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ tests_require = [
     'coverage',
     'pytest-cov',
     'fakeredis',
+    'lupa',
     'pytest-asyncio',
     'flake8',
     'mypy',
@@ -0,0 +1,98 @@
+"""Tests for the read cache"""
+import asyncio
+import time
+
+import pytest
+
+from antismash_models.cache import ReadCache
+from antismash_models.control import AsyncControl
+from antismash_models.notice import SyncNotice
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_and_ttl():
+    clock = FakeClock()
+    cache = ReadCache(max_size=2, ttl=10, clock=clock)
+    cache.put('a', ['1'])
+    cache.put('b', ['2'])
+    assert cache.get('a') == ['1']
+    cache.put('c', ['3'])
+    # b was least recently used
+    assert cache.get('b') is None
+    assert len(cache) == 2
+
+    clock.now = 11
+    assert cache.get('a') is None
+    assert cache.hits == 1
+    assert cache.misses == 2
+    assert len(cache) == 1
+
+
+def test_handle_message():
+    cache = ReadCache()
+    cache.put('notice:fake', ['info'])
+    cache.handle_message({'type': 'psubscribe', 'channel': '__keyspace@*__:notice:*', 'data': 1})
+    assert cache.get('notice:fake') == ['info']
+    cache.handle_message({'type': 'pmessage', 'channel': b'__keyspace@0__:notice:fake', 'data': 'hset'})
+    assert cache.get('notice:fake') is None
+
+
+class CachedNotice(SyncNotice):
+    __slots__ = ()
+
+
+def test_sync_fetch_cached(sync_db):
+    CachedNotice.CACHE = ReadCache()
+    notice = CachedNotice(sync_db, 'fake', text='first')
+    notice.commit()
+
+    CachedNotice(sync_db, 'fake').fetch()
+    sync_db.hset('notice:fake', 'text', 'changed elsewhere')
+    assert CachedNotice(sync_db, 'fake').fetch().text == 'first'
+    assert CachedNotice.CACHE.hits == 1
+
+    # partial fetches bypass the cache
+    assert CachedNotice(sync_db, 'fake').fetch(fields=['text']).text == 'changed elsewhere'
+
+    # local commits invalidate
+    notice.text = 'second'
+    notice.commit()
+    assert CachedNotice(sync_db, 'fake').fetch().text == 'second'
+
+
+def test_sync_listen(sync_db):
+    cache = ReadCache()
+    cache.put('notice:fake', ['info'])
+    thread = cache.listen(sync_db, SyncNotice.KEY_PREFIX, sleep_time=0.01)
+    try:
+        for _ in range(100):
+            sync_db.publish('__keyspace@0__:notice:fake', 'hset')
+            if not len(cache):
+                break
+            time.sleep(0.01)
+        assert cache.get('notice:fake') is None
+    finally:
+        thread.stop()
+
+
+@pytest.mark.asyncio
+async def test_async_listen(async_db):
+    cache = ReadCache()
+    cache.put('control:name', ['1'])
+    task = asyncio.create_task(cache.listen_async(async_db, AsyncControl.KEY_PREFIX))
+    try:
+        for _ in range(100):
+            await async_db.publish('__keyspace@0__:control:name', 'expired')
+            if not len(cache):
+                break
+            await asyncio.sleep(0.01)
+        assert cache.get('control:name') is None
+    finally:
+        task.cancel()
@@ -2,7 +2,8 @@ import asyncio
 import pytest
 import time
 
-from antismash_models.control import AsyncControl, SyncControl
+from antismash_models.base import ConflictError
+from antismash_models.control import AsyncControl, SyncControl, CONTROL_TIMEOUT, LEASES_KEY
 
 
 def test_init(sync_db):
@@ -88,3 +89,223 @@ def test_sync_alive(sync_db):
     control.alive()
     new_ttl = sync_db.ttl('control:name')
     assert -1 < old_ttl <= new_ttl
+
+
+def test_sync_alive_lease(sync_db):
+    control = SyncControl(sync_db, 'name', 42)
+    control.commit()
+    lease = sync_db.zscore(LEASES_KEY, 'name')
+    assert lease > time.time()
+
+    sync_db.zadd(LEASES_KEY, {'name': 0})
+    assert control.alive()
+    assert sync_db.zscore(LEASES_KEY, 'name') >= lease
+
+
+def test_sync_live_and_reserve(sync_db):
+    SyncControl(sync_db, 'busy', 4).commit()
+    SyncControl(sync_db, 'idle', 2).commit()
+    stopping = SyncControl(sync_db, 'stopping', 8)
+    stopping.stop_scheduled = True
+    stopping.commit()
+    SyncControl(sync_db, 'lapsed', 8).commit()
+    sync_db.zadd(LEASES_KEY, {'lapsed': 0})
+    SyncControl(sync_db, 'expired', 8).commit()
+    sync_db.delete('control:expired')
+    sync_db.hset('control:busy', 'running_jobs', 1)
+
+    assert sorted(control.name for control in SyncControl.live(sync_db)) == ['busy', 'idle', 'stopping']
+
+    control = SyncControl.reserve(sync_db)
+    assert control.name == 'idle'
+    assert control.running_jobs == 1
+    assert SyncControl.reserve(sync_db).name == 'busy'
+    names = [SyncControl.reserve(sync_db).name for _ in range(3)]
+    assert sorted(names) == ['busy', 'busy', 'idle']
+    assert SyncControl.reserve(sync_db) is None
+    assert sync_db.hmget('control:busy', 'running_jobs') == ['4']
+    assert sync_db.hget('control:stopping', 'running_jobs') == '0'
+
+
+@pytest.mark.asyncio
+async def test_async_live_and_reserve(async_db):
+    assert await AsyncControl.live(async_db) == []
+    assert await AsyncControl.reserve(async_db) is None
+
+    await AsyncControl(async_db, 'name', 1).commit()
+    live = await AsyncControl.live(async_db)
+    assert [control.name for control in live] == ['name']
+    assert live[0].max_jobs == 1
+    assert (await AsyncControl.reserve(async_db)).running_jobs == 1
+    assert await AsyncControl.reserve(async_db) is None
+
+
+def test_sync_incr_field(sync_db):
+    control = SyncControl(sync_db, 'name', 42)
+    control.commit()
+    sync_db.persist('control:name')
+    other = SyncControl(sync_db, 'name', 42)
+    other.fetch()
+
+    assert control.incr_field('running_jobs') == 1
+    assert other.incr_field('running_jobs', 2) == 3
+    assert control.decr_field('running_jobs') == 2
+    assert control.running_jobs == 2
+    assert sync_db.hget('control:name', 'running_jobs') == '2'
+    assert -1 < sync_db.ttl('control:name') <= CONTROL_TIMEOUT
+
+    # the incremented value isn't written again by a commit
+    control.status = 'busy'
+    control.commit()
+    assert sync_db.hget('control:name', 'running_jobs') == '2'
+
+    with pytest.raises(ValueError):
+        control.incr_field('status')
+    with pytest.raises(ValueError):
+        control.incr_field('running_jobs', 0.5)
+
+
+@pytest.mark.asyncio
+async def test_async_incr_field(async_db):
+    control = AsyncControl(async_db, 'name', 42)
+    await control.commit()
+
+    assert await control.incr_field('running_jobs', 5) == 5
+    assert await control.decr_field('running_jobs', 2) == 3
+    assert control._dirty == set()
+    assert await async_db.hget('control:name', 'running_jobs') == '3'
+
+
+def test_sync_heartbeat(sync_db):
+    control = SyncControl(sync_db, 'name', 42)
+    control.commit()
+    sync_db.persist('control:name')
+
+    with pytest.raises(ValueError):
+        control.start_heartbeat(1.5)
+
+    thread = control.start_heartbeat(0.1 / CONTROL_TIMEOUT)
+    with pytest.raises(ValueError):
+        control.start_heartbeat()
+    control.status = 'busy'
+    time.sleep(0.3)
+    assert sync_db.ttl('control:name') > -1
+    assert sync_db.hget('control:name', 'status') == 'busy'
+    assert control._dirty == set()
+
+    control.stop_heartbeat()
+    assert not thread.is_alive()
+    # stopping twice is fine
+    control.stop_heartbeat()
+
+
+@pytest.mark.asyncio
+async def test_async_heartbeat(async_db):
+    control = AsyncControl(async_db, 'name', 42)
+    await control.commit()
+    await async_db.persist('control:name')
+
+    task = control.start_heartbeat(0.1 / CONTROL_TIMEOUT)
+    control.running_jobs = 2
+    await asyncio.sleep(0.3)
+    assert await async_db.ttl('control:name') > -1
+    assert await async_db.hget('control:name', 'running_jobs') == '2'
+
+    await control.stop_heartbeat()
+    assert task.done()
+
+
+def test_heartbeat_keeps_changes_made_in_flight(sync_db):
+    control = SyncControl(sync_db, 'name', 42)
+    control.commit()
+    control.status = 'first'
+    pipe = sync_db.pipeline(transaction=True)
+    written = control._queue_beat(pipe)
+    control.status = 'second'
+    pipe.execute()
+    control._mark_written(written)
+    assert control._dirty == {'status'}
+
+
+def test_sync_fetch_many(sync_db):
+    SyncControl(sync_db, 'first', 42, 'abc').commit()
+
+    first, missing = SyncControl.fetch_many(sync_db, ['first', 'missing'])
+    assert first.name == 'first'
+    assert first.max_jobs == 42
+    assert first.version == 'abc'
+    assert missing is None
+
+
+def test_sync_commit_many(sync_db):
+    controls = [SyncControl(sync_db, 'first', 42), SyncControl(sync_db, 'second', 23)]
+    results = SyncControl.commit_many(controls)
+    assert len(results) == 2
+
+    assert -1 < sync_db.ttl('control:first') <= CONTROL_TIMEOUT
+    assert -1 < sync_db.ttl('control:second') <= CONTROL_TIMEOUT
+
+    # nothing left to write, only the expiry is refreshed, same result as commit()
+    assert SyncControl.commit_many(controls) == [0, 0]
+    assert controls[0].commit() == 0
+
+
+def test_sync_alive_with_status(sync_db):
+    control = SyncControl(sync_db, 'name', 42)
+    control.commit()
+    sync_db.persist('control:name')
+
+    assert control.alive('stopping')
+    assert control.status == 'stopping'
+    assert sync_db.hget('control:name', 'status') == 'stopping'
+    assert -1 < sync_db.ttl('control:name') <= CONTROL_TIMEOUT
+
+    # pending changes get written by a plain heartbeat as well
+    control.running_jobs = 3
+    sync_db.persist('control:name')
+    assert control.alive()
+    assert sync_db.hget('control:name', 'running_jobs') == '3'
+    assert -1 < sync_db.ttl('control:name') <= CONTROL_TIMEOUT
+
+
+@pytest.mark.asyncio
+async def test_async_alive_with_status(async_db):
+    control = AsyncControl(async_db, 'name', 42)
+    await control.commit()
+    await async_db.persist('control:name')
+
+    assert await control.alive('stopping')
+    assert await async_db.hget('control:name', 'status') == 'stopping'
+    assert -1 < await async_db.ttl('control:name') <= CONTROL_TIMEOUT
+
+
+class VersionedSyncControl(SyncControl):
+    __slots__ = ()
+    VERSIONED = True
+
+
+def test_sync_versioned_control(sync_db):
+    control = VersionedSyncControl(sync_db, 'name', 2)
+    assert control.commit() > 0
+    assert control.alive('busy')
+    assert sync_db.hget('control:name', 'revision') == '2'
+
+    control.fetch()
+    assert control.revision == 2
+    assert control.incr_field('running_jobs') == 1
+    assert VersionedSyncControl.reserve(sync_db).revision == 4
+    assert [c.revision for c in VersionedSyncControl.live(sync_db)] == [4]
+
+    with pytest.raises(ConflictError):
+        control.commit(if_version=2)
+    control.status = 'idle'
+    control.commit(if_version=4)
+    assert sync_db.hget('control:name', 'revision') == '5'
+    assert -1 < sync_db.ttl('control:name') <= CONTROL_TIMEOUT
+
+    # plain controls, e.g. a dispatcher's heartbeat, count their writes as well
+    plain = SyncControl(sync_db, 'name', 2).fetch()
+    assert plain.alive('busy again')
+    assert sync_db.hget('control:name', 'revision') == '6'
+    with pytest.raises(ConflictError):
+        control.commit(if_version=5)
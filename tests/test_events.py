@@ -0,0 +1,71 @@
+import pytest
+
+from antismash_models.events import AsyncEventConsumer, JobEvent, SyncEventConsumer
+from antismash_models.job import AsyncJob, SyncJob
+
+
+@pytest.fixture
+def sync_events(monkeypatch):
+    monkeypatch.setattr(SyncJob, 'EVENTS_MAX_LENGTH', 100)
+
+
+@pytest.fixture
+def async_events(monkeypatch):
+    monkeypatch.setattr(AsyncJob, 'EVENTS_MAX_LENGTH', 100)
+
+
+def test_no_events_by_default(sync_db):
+    SyncJob(sync_db, 'bacteria-quiet').commit()
+    assert not sync_db.exists('jobs:events')
+
+
+def test_sync_events(sync_db, sync_events):
+    consumer = SyncEventConsumer(sync_db, 'mailer', 'mailer-1')
+    consumer.create_group()
+    # creating an existing group is fine
+    consumer.create_group()
+
+    job = SyncJob(sync_db, 'bacteria-events')
+    job.commit()
+    job.status = 'running the thing'
+    job.commit()
+    job.state = 'queued'
+    job.commit()
+    sync_db.lpush('jobs:queued', job.job_id)
+    SyncJob.claim(sync_db, 'jobs:queued', 'worker')
+
+    events = consumer.read()
+    assert [(event.job_id, event.taxon, event.old_state, event.new_state) for event in events] == [
+        ('bacteria-events', 'bacteria', '', 'created'),
+        ('bacteria-events', 'bacteria', 'created', 'queued'),
+        ('bacteria-events', 'bacteria', 'queued', 'running'),
+    ]
+    assert consumer.read() == []
+
+    # unacknowledged events can be taken over by another consumer
+    other = SyncEventConsumer(sync_db, 'mailer', 'mailer-2')
+    assert other.reclaim(0, count=1) == events[:1]
+    assert other.ack(*events) == 3
+    assert other.ack() == 0
+    assert other.reclaim(0) == []
+
+    # every group sees every event
+    stats = SyncEventConsumer(sync_db, 'stats', 'stats-1')
+    stats.create_group('0')
+    assert len(stats.read(count=2)) == 2
+
+
+@pytest.mark.asyncio
+async def test_async_events(async_db, async_events):
+    consumer = AsyncEventConsumer(async_db, 'web', 'web-1')
+    await consumer.create_group()
+    job = AsyncJob(async_db, 'bacteria-events')
+    job.state = 'done'
+    await job.commit()
+
+    events = await consumer.read(block=10)
+    assert len(events) == 1
+    assert isinstance(events[0], JobEvent)
+    assert events[0].new_state == 'done'
+    assert await consumer.ack(*events) == 1
+    assert await consumer.reclaim(0) == []
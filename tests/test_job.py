@@ -1,6 +1,9 @@
+from datetime import datetime
+
 import pytest
 from antismash_models import utils
-from antismash_models.job import BaseJob, AsyncJob, SyncJob
+from antismash_models.base import ConflictError
+from antismash_models.job import _COMMIT_SCRIPT, BaseJob, AsyncJob, SyncJob
 
 
 def test_init(sync_db):
@@ -160,6 +163,37 @@ def test_to_dict(sync_db):
     assert ret == expected
 
 
+def test_date_round_trip(sync_db):
+    job = BaseJob(sync_db, 'taxon-fake')
+    job.added = datetime(2024, 2, 29, 23, 59, 58, 123456)
+    job.last_changed = datetime(2024, 3, 1, 0, 0, 1)
+
+    copy = BaseJob.fromExisting('taxon-copy', job)
+    assert copy.added == job.added
+    assert copy.last_changed == job.last_changed
+    assert copy.to_dict()['added'] == job.to_dict()['added'] == '2024-02-29 23:59:58.123456'
+
+
+@pytest.mark.parametrize("value, expected", [
+    ('2024-02-29 23:59:58.123456', datetime(2024, 2, 29, 23, 59, 58, 123456)),
+    ('2024-02-29 23:59:58', datetime(2024, 2, 29, 23, 59, 58)),
+    # legacy values only strptime can handle
+    ('2024-02-29 23:59:58.5', datetime(2024, 2, 29, 23, 59, 58, 500000)),
+    ('2024-2-9 3:59:58', datetime(2024, 2, 9, 3, 59, 58)),
+])
+def test_parse_dates(sync_db, value, expected):
+    job = BaseJob(sync_db, 'taxon-fake')
+    job._parse(('added',), (value,))
+    assert job.added == expected
+
+
+@pytest.mark.parametrize("value", ['2024-02-29T23:59:58', '2024-02-29 23:59+01:00', 'yesterday'])
+def test_parse_dates_invalid(sync_db, value):
+    job = BaseJob(sync_db, 'taxon-fake')
+    with pytest.raises(ValueError):
+        job._parse(('added',), (value,))
+
+
 def test_str(sync_db):
     fake_id = 'taxon-fake'
     job = BaseJob(sync_db, fake_id)
@@ -253,6 +287,547 @@ def test_sync_fetch_invalid(sync_db):
         job.fetch()
 
 
+@pytest.mark.asyncio
+async def test_async_fetch_many(async_db):
+    defaults = {'genefinder': 'none', 'molecule_type': 'nucl'}
+    await async_db.hset('job:taxon-first', mapping=dict(defaults, state='queued', seed=42))
+    await async_db.hset('job:taxon-second', mapping=dict(defaults, state='running'))
+
+    jobs = await AsyncJob.fetch_many(async_db, ['taxon-first', 'taxon-missing', 'taxon-second'])
+    assert len(jobs) == 3
+    assert jobs[0].job_id == 'taxon-first'
+    assert jobs[0].state == 'queued'
+    assert jobs[0].seed == 42
+    assert jobs[1] is None
+    assert jobs[2].state == 'running'
+
+
+def test_sync_fetch_many(sync_db):
+    defaults = {'genefinder': 'none', 'molecule_type': 'nucl'}
+    sync_db.hset('job:taxon-first', mapping=dict(defaults, state='queued', seed=42))
+    sync_db.hset('job:taxon-second', mapping=dict(defaults, state='running'))
+
+    jobs = SyncJob.fetch_many(sync_db, ['taxon-first', 'taxon-missing', 'taxon-second'])
+    assert len(jobs) == 3
+    assert jobs[0].job_id == 'taxon-first'
+    assert jobs[0].state == 'queued'
+    assert jobs[0].seed == 42
+    assert jobs[1] is None
+    assert jobs[2].state == 'running'
+
+    assert SyncJob.fetch_many(sync_db, []) == []
+
+
+@pytest.mark.asyncio
+async def test_async_commit_many(async_db):
+    jobs = [AsyncJob(async_db, 'taxon-first'), AsyncJob(async_db, 'taxon-second')]
+    results = await AsyncJob.commit_many(jobs)
+    assert len(results) == 2
+    assert await async_db.exists('job:taxon-first', 'job:taxon-second') == 2
+
+
+def test_sync_commit_many(sync_db):
+    sync_db.set('job:taxon-broken', 'not a hash')
+    jobs = [SyncJob(sync_db, 'taxon-first'), SyncJob(sync_db, 'taxon-broken'), SyncJob(sync_db, 'taxon-second')]
+
+    results = SyncJob.commit_many(jobs)
+    assert len(results) == 3
+    assert results[0] > 0
+    assert isinstance(results[1], Exception)
+    assert results[2] > 0
+    assert sync_db.exists('job:taxon-first', 'job:taxon-second') == 2
+
+    assert SyncJob.commit_many([]) == []
+
+
+def test_sync_commit_many_transaction(sync_db):
+    jobs = [SyncJob(sync_db, 'taxon-first'), SyncJob(sync_db, 'taxon-second')]
+    results = SyncJob.commit_many(jobs, transaction=True)
+    assert all(res > 0 for res in results)
+    assert sync_db.exists('job:taxon-first', 'job:taxon-second') == 2
+
+
+def test_sync_commit_changed_only(sync_db):
+    job = SyncJob(sync_db, 'taxon-fake')
+    job.email = 'alice@example.org'
+    job.commit()
+
+    job = SyncJob(sync_db, 'taxon-fake').fetch()
+    assert job._changes() == {}
+
+    # simulate a concurrent change of an unrelated field
+    sync_db.hset('job:taxon-fake', 'email', 'bob@example.org')
+
+    job.state = 'queued'
+    job.status = 'queued'
+    assert set(job._changes()) == {'last_changed', 'state', 'status'}
+    job.commit()
+    assert sync_db.hget('job:taxon-fake', 'state') == 'queued'
+    assert sync_db.hget('job:taxon-fake', 'email') == 'bob@example.org'
+
+    job.commit(full=True)
+    assert sync_db.hget('job:taxon-fake', 'email') == 'alice@example.org'
+
+
+@pytest.mark.asyncio
+async def test_async_commit_changed_only(async_db):
+    job = AsyncJob(async_db, 'taxon-fake')
+    job.email = 'alice@example.org'
+    await job.commit()
+
+    await async_db.hset('job:taxon-fake', 'email', 'bob@example.org')
+    job.status = 'queued'
+    await job.commit()
+    assert await async_db.hget('job:taxon-fake', 'status') == 'queued'
+    assert await async_db.hget('job:taxon-fake', 'email') == 'bob@example.org'
+
+
+def test_lazy_list_fields(sync_db):
+    job = SyncJob(sync_db, 'taxon-fake')
+    job.trace.append('web')
+    job.target_queues = ['jobs:queued']
+    job.commit()
+
+    job = SyncJob(sync_db, 'taxon-fake').fetch()
+    assert job._raw == {'sideloads': '[]', 'target_queues': '["jobs:queued"]', 'trace': '["web"]'}
+    # untouched list fields are passed through as stored
+    assert job.to_dict()['trace'] == '["web"]'
+
+    assert job.trace == ['web']
+    assert 'trace' not in job._raw
+    job.trace.append('dispatcher')
+    assert job._changes() == {'trace': '["web", "dispatcher"]'}
+
+    job.target_queues = []
+    assert 'target_queues' not in job._raw
+    job.commit()
+
+    job = SyncJob(sync_db, 'taxon-fake').fetch()
+    assert job.trace == ['web', 'dispatcher']
+    assert job.target_queues == []
+    assert job.sideloads == []
+
+
+def test_sync_fetch_removed_lazy_list(sync_db):
+    job = SyncJob(sync_db, 'bacteria-lazy')
+    job.trace = ['first']
+    job.commit()
+    job.fetch()
+    sync_db.hdel('job:bacteria-lazy', 'trace')
+    # the trace was never accessed after the first fetch, so it was still raw
+    job.fetch()
+    assert job.trace == []
+
+
+def test_sync_fetch_fields(sync_db):
+    job = SyncJob(sync_db, 'taxon-fake')
+    job.email = 'alice@example.org'
+    job.trace.append('web')
+    job.commit()
+
+    job = SyncJob(sync_db, 'taxon-fake').fetch(fields=['state', 'status', 'dispatcher'])
+    assert job.is_partial
+    assert job.state == 'created'
+    assert job.email is None
+    assert job.trace == []
+
+    # unloaded fields, including list fields, are never written
+    job.status = 'queued'
+    job.commit()
+    assert sync_db.hget('job:taxon-fake', 'status') == 'queued'
+    assert sync_db.hget('job:taxon-fake', 'email') == 'alice@example.org'
+    assert sync_db.hget('job:taxon-fake', 'trace') == '["web"]'
+
+    with pytest.raises(ValueError):
+        job.commit(full=True)
+
+    job.fetch()
+    assert not job.is_partial
+    assert job.email == 'alice@example.org'
+
+    with pytest.raises(ValueError):
+        job.fetch(fields=['state', 'nope'])
+
+
+@pytest.mark.asyncio
+async def test_async_fetch_many_fields(async_db):
+    await AsyncJob(async_db, 'taxon-first').commit()
+
+    job, missing = await AsyncJob.fetch_many(async_db, ['taxon-first', 'taxon-missing'], fields=['state'])
+    assert job.is_partial
+    assert job.state == 'created'
+    assert missing is None
+
+
+def test_sync_iter_all(sync_db):
+    for i in range(25):
+        job = SyncJob(sync_db, '{}-{}'.format('fungi' if i % 5 == 0 else 'bacteria', i))
+        job.state = 'queued' if i % 2 == 0 else 'running'
+        job.commit()
+    # other key types sharing the prefix are skipped
+    sync_db.rpush('job:fungi-0:extra', 'not a job')
+
+    assert len(list(SyncJob.iter_all(sync_db, batch_size=10))) == 25
+
+    jobs = list(SyncJob.iter_all(sync_db, batch_size=10, fields=['status'], state='queued', taxon='fungi'))
+    assert sorted(job.job_id for job in jobs) == ['fungi-0', 'fungi-10', 'fungi-20']
+    assert all(job.is_partial for job in jobs)
+
+    jobs = list(SyncJob.iter_all(sync_db, state={'queued', 'running'}, taxon='fungi'))
+    assert len(jobs) == 5
+
+    with pytest.raises(ValueError):
+        list(SyncJob.iter_all(sync_db, nope='foo'))
+
+
+@pytest.mark.asyncio
+async def test_async_iter_all(async_db):
+    for i in range(5):
+        job = AsyncJob(async_db, 'bacteria-{}'.format(i))
+        job.state = 'queued' if i < 3 else 'running'
+        await job.commit()
+
+    jobs = [job async for job in AsyncJob.iter_all(async_db, batch_size=2, state='queued')]
+    assert sorted(job.job_id for job in jobs) == ['bacteria-0', 'bacteria-1', 'bacteria-2']
+
+
+def test_sync_indexes(sync_db):
+    job = SyncJob(sync_db, 'fungi-first')
+    job.state = 'queued'
+    job.jobtype = 'antismash8'
+    job.commit()
+    other = SyncJob(sync_db, 'bacteria-second')
+    other.state = 'queued'
+    other.commit()
+
+    assert sync_db.smembers('jobs:state:queued') == {'fungi-first', 'bacteria-second'}
+    assert sync_db.smembers('jobs:taxon:fungi') == {'fungi-first'}
+    assert [j.job_id for j in SyncJob.find(sync_db, state='queued')] == ['bacteria-second', 'fungi-first']
+    assert [j.job_id for j in SyncJob.find(sync_db, state='queued', taxon='fungi')] == ['fungi-first']
+
+    # stale memberships are removed when a value changes
+    job.state = 'running'
+    job.dispatcher = 'worker'
+    job.commit()
+    assert sync_db.smembers('jobs:state:queued') == {'bacteria-second'}
+    assert sync_db.smembers('jobs:state:running') == {'fungi-first'}
+    found = SyncJob.find(sync_db, fields=['state'], state='running', dispatcher='worker')
+    assert [j.job_id for j in found] == ['fungi-first']
+    assert found[0].is_partial
+
+    job.delete()
+    assert not sync_db.exists('jobs:state:running', 'jobs:dispatcher:worker', 'jobs:taxon:fungi')
+    assert SyncJob.find(sync_db, state='running') == []
+
+    with pytest.raises(ValueError):
+        SyncJob.find(sync_db)
+    with pytest.raises(ValueError):
+        SyncJob.find(sync_db, email='alice@example.org')
+
+
+def test_sync_reindex(sync_db):
+    job = SyncJob(sync_db, 'fungi-first')
+    job.state = 'queued'
+    job.commit()
+    sync_db.delete('jobs:state:queued', 'jobs:taxon:fungi')
+    sync_db.sadd('jobs:state:running', 'fungi-first')
+    sync_db.sadd('jobs:blocked_ips', '192.0.2.1')
+
+    assert SyncJob.reindex(sync_db, batch_size=1) == 1
+    assert sync_db.smembers('jobs:state:queued') == {'fungi-first'}
+    assert sync_db.smembers('jobs:taxon:fungi') == {'fungi-first'}
+    assert not sync_db.exists('jobs:state:running')
+    # sets that aren't indexes are kept
+    assert sync_db.smembers('jobs:blocked_ips') == {'192.0.2.1'}
+
+
+def test_sync_reindex_legacy(sync_db):
+    legacy = SyncJob(sync_db, 'a7db5650-ec0d-4ca8-b3b2-c5de27a8cdf3')
+    legacy.status = 'done: All finished'
+    legacy.commit()
+    assert sync_db.smembers('jobs:state:done') == {legacy.job_id}
+
+    sync_db.delete('jobs:state:done', 'jobs:taxon:bacteria')
+    assert SyncJob.reindex(sync_db) == 1
+    # indexed on the stored state, the same way the commit script did
+    assert sync_db.smembers('jobs:state:done') == {legacy.job_id}
+    assert sync_db.smembers('jobs:taxon:bacteria') == {legacy.job_id}
+
+
+@pytest.mark.asyncio
+async def test_async_indexes(async_db):
+    job = AsyncJob(async_db, 'fungi-first')
+    job.state = 'queued'
+    await job.commit()
+    await async_db.delete('jobs:taxon:fungi')
+
+    assert await AsyncJob.reindex(async_db) == 1
+    assert [j.job_id for j in await AsyncJob.find(async_db, state='queued', taxon='fungi')] == ['fungi-first']
+
+    await job.delete()
+    assert await AsyncJob.find(async_db, state='queued') == []
+
+
+def test_sync_job_stats(sync_db):
+    jobs = [SyncJob(sync_db, 'fungi-first'), SyncJob(sync_db, 'fungi-second'), SyncJob(sync_db, 'bacteria-third')]
+    for job in jobs:
+        job.state = 'queued'
+    SyncJob.commit_many(jobs)
+    assert SyncJob.job_stats(sync_db) == {'fungi': {'queued': 2}, 'bacteria': {'queued': 1}}
+
+    jobs[0].state = 'running'
+    jobs[0].commit()
+    # committing without a state change doesn't count twice
+    jobs[1].status = 'still waiting'
+    jobs[1].commit()
+    assert SyncJob.job_stats(sync_db) == {'fungi': {'queued': 1, 'running': 1}, 'bacteria': {'queued': 1}}
+
+    jobs[2].delete()
+    assert SyncJob.job_stats(sync_db)['bacteria'] == {'queued': 0}
+
+    sync_db.delete('jobs:stats')
+    expected = {'fungi': {'queued': 1, 'running': 1}}
+    assert SyncJob.reconcile_stats(sync_db, batch_size=1) == expected
+    assert SyncJob.job_stats(sync_db) == expected
+
+
+@pytest.mark.asyncio
+async def test_async_job_stats(async_db):
+    job = AsyncJob(async_db, 'fungi-first')
+    job.state = 'queued'
+    await job.commit()
+    assert await AsyncJob.job_stats(async_db) == {'fungi': {'queued': 1}}
+
+    await async_db.hset('jobs:stats', 'fungi:queued', 5)
+    assert await AsyncJob.reconcile_stats(async_db) == {'fungi': {'queued': 1}}
+    assert await AsyncJob.job_stats(async_db) == {'fungi': {'queued': 1}}
+
+
+def test_sync_reconcile_stats_legacy(sync_db):
+    legacy = SyncJob(sync_db, 'a7db5650-ec0d-4ca8-b3b2-c5de27a8cdf3')
+    legacy.status = 'failed: out of memory'
+    legacy.commit()
+    SyncJob(sync_db, 'fungi-first').commit()
+    counted = SyncJob.job_stats(sync_db)
+    assert counted == {'bacteria': {'failed': 1}, 'fungi': {'created': 1}}
+
+    # reconciling counts the stored state like the commit script did
+    assert SyncJob.reconcile_stats(sync_db) == counted
+    assert SyncJob.job_stats(sync_db) == counted
+
+
+def test_sync_claim(sync_db):
+    for job_id in ['fungi-first', 'bacteria-second']:
+        job = SyncJob(sync_db, job_id)
+        job.state = 'queued'
+        job.target_queues = ['jobs:fast', 'jobs:queued']
+        job.commit()
+    sync_db.lpush('jobs:queued', 'fungi-first', 'bacteria-deleted', 'bacteria-second')
+
+    assert SyncJob.claim(sync_db, 'jobs:empty', 'worker') is None
+
+    job = SyncJob.claim(sync_db, ['jobs:fast', 'jobs:queued'], 'worker')
+    assert job.job_id == 'fungi-first'
+    assert job.state == 'running'
+    assert job.dispatcher == 'worker'
+    assert job.target_queues == ['jobs:fast', 'jobs:queued']
+    assert sync_db.hget('job:fungi-first', 'state') == 'running'
+    assert sync_db.smembers('jobs:state:running') == {'fungi-first'}
+    assert sync_db.smembers('jobs:dispatcher:worker') == {'fungi-first'}
+    assert SyncJob.job_stats(sync_db)['fungi'] == {'queued': 0, 'running': 1}
+
+    # IDs of deleted jobs are skipped
+    job = SyncJob.claim(sync_db, 'jobs:queued', 'worker')
+    assert job.job_id == 'bacteria-second'
+    assert sync_db.llen('jobs:queued') == 0
+
+    with pytest.raises(ValueError):
+        SyncJob.claim(sync_db, [], 'worker')
+
+
+@pytest.mark.asyncio
+async def test_async_claim(async_db):
+    job = AsyncJob(async_db, 'a7db5650-ec0d-4ca8-b3b2-c5de27a8cdf3')
+    job.state = 'queued'
+    await job.commit()
+    await async_db.lpush('jobs:queued', job.job_id)
+
+    job = await AsyncJob.claim(async_db, 'jobs:queued', 'worker')
+    assert job.dispatcher == 'worker'
+    # legacy job IDs are counted as bacteria
+    assert (await AsyncJob.job_stats(async_db))['bacteria']['running'] == 1
+    assert await AsyncJob.claim(async_db, 'jobs:queued', 'worker') is None
+
+
+def test_sync_reap(sync_db):
+    for job_id in ['bacteria-requeue', 'fungi-noqueue', 'bacteria-alive']:
+        job = SyncJob(sync_db, job_id)
+        job.state = 'queued'
+        if job_id != 'fungi-noqueue':
+            job.target_queues = ['jobs:fast', 'jobs:queued']
+        job.commit()
+        sync_db.lpush('jobs:queued', job_id)
+    SyncJob.claim(sync_db, 'jobs:queued', 'dead')
+    SyncJob.claim(sync_db, 'jobs:queued', 'dead')
+    SyncJob.claim(sync_db, 'jobs:queued', 'live')
+    # claiming takes out a lease, let the one of the dead dispatcher lapse
+    assert sync_db.zscore('controls:leases', 'live') > utils.to_timestamp(utils.now())
+    sync_db.zadd('controls:leases', {'dead': 0})
+
+    assert sorted(SyncJob.reap(sync_db)) == ['bacteria-requeue', 'fungi-noqueue']
+    assert sync_db.hmget('job:bacteria-requeue', 'state', 'dispatcher') == ['queued', None]
+    assert sync_db.lrange('jobs:fast', 0, -1) == ['bacteria-requeue']
+    assert sync_db.hmget('job:fungi-noqueue', 'state', 'status') == ['failed', 'failed: dispatcher lease expired']
+    assert sync_db.smembers('jobs:state:running') == {'bacteria-alive'}
+    assert sync_db.smembers('jobs:dispatcher:dead') == {'fungi-noqueue'}
+    assert SyncJob.job_stats(sync_db)['bacteria'] == {'queued': 1, 'running': 1}
+    assert sync_db.zrange('controls:leases', 0, -1) == ['live']
+
+    assert SyncJob.reap(sync_db) == []
+    with pytest.raises(ValueError):
+        SyncJob.reap(sync_db, 'ignore')
+
+
+def test_sync_claim_renews_lapsed_lease(sync_db):
+    job = SyncJob(sync_db, 'bacteria-1')
+    job.state = 'queued'
+    job.commit()
+    sync_db.lpush('jobs:queued', job.job_id)
+    # the dispatcher missed a heartbeat, but is still alive and claiming
+    sync_db.zadd('controls:leases', {'worker': 1.0})
+
+    assert SyncJob.claim(sync_db, 'jobs:queued', 'worker').state == 'running'
+    assert sync_db.zscore('controls:leases', 'worker') > utils.to_timestamp(utils.now())
+    assert SyncJob.reap(sync_db) == []
+
+    # a longer lease taken out by a heartbeat isn't shortened
+    sync_db.zadd('controls:leases', {'worker': 2 ** 40})
+    sync_db.lpush('jobs:queued', job.job_id)
+    SyncJob.claim(sync_db, 'jobs:queued', 'worker')
+    assert sync_db.zscore('controls:leases', 'worker') == 2 ** 40
+
+
+@pytest.mark.asyncio
+async def test_async_reap(async_db):
+    job = AsyncJob(async_db, 'bacteria-running')
+    job.state = 'queued'
+    await job.commit()
+    await async_db.lpush('jobs:queued', job.job_id)
+    await AsyncJob.claim(async_db, 'jobs:queued', 'dead')
+
+    assert await AsyncJob.reap(async_db, 'fail') == []
+    await async_db.zadd('controls:leases', {'dead': 0})
+    assert await AsyncJob.reap(async_db, 'fail') == ['bacteria-running']
+    await job.fetch()
+    assert job.state == 'failed'
+
+
+def test_sync_incr_float_field(sync_db):
+    job = SyncJob(sync_db, 'bacteria-float')
+    job.cf_threshold = 0.5
+    job.commit()
+
+    assert job.incr_field('cf_threshold', 0.25) == 0.75
+    assert job.decr_field('cf_threshold') == -0.25
+    assert sync_db.hget('job:bacteria-float', 'cf_threshold') == '-0.25'
+
+
+def test_sync_trace_list(sync_db, monkeypatch):
+    monkeypatch.setattr(SyncJob, 'TRACE_MAX_LENGTH', 3)
+    job = SyncJob(sync_db, 'bacteria-trace')
+    job.trace.append('web')
+    job.commit()
+
+    job.append_trace('dispatcher')
+    job.append_trace('worker', 'done')
+    assert sync_db.lrange('job:bacteria-trace:trace', 0, -1) == ['dispatcher', 'worker', 'done']
+    # the job hash isn't rewritten
+    assert sync_db.hget('job:bacteria-trace', 'trace') == '["web"]'
+    assert job.fetch_trace() == ['web', 'dispatcher', 'worker', 'done']
+
+    job.append_trace('cleanup')
+    assert job.fetch_trace() == ['web', 'worker', 'done', 'cleanup']
+    with pytest.raises(ValueError):
+        job.append_trace()
+
+    job.delete()
+    assert not sync_db.exists('job:bacteria-trace:trace')
+    assert job.fetch_trace() == []
+
+
+@pytest.mark.asyncio
+async def test_async_trace_list(async_db):
+    job = AsyncJob(async_db, 'bacteria-trace')
+    await job.commit()
+
+    await job.append_trace('dispatcher')
+    assert await job.fetch_trace() == ['dispatcher']
+    # the trace list isn't picked up by iter_all
+    assert [j.job_id async for j in AsyncJob.iter_all(async_db)] == ['bacteria-trace']
+
+
+def test_sync_clone_many(sync_db):
+    for job_id in ['bacteria-first', 'fungi-second']:
+        job = SyncJob(sync_db, job_id)
+        job.state = 'failed'
+        job.dispatcher = 'worker'
+        job.target_queues = ['jobs:queued']
+        job.commit()
+    sync_db.hset('job:bacteria-taken', 'state', 'done')
+    added = datetime(2020, 1, 2, 3, 4, 5, 6)
+
+    results = SyncJob.clone_many(sync_db, [('bacteria-first', 'bacteria-first-retry'),
+                                           ('bacteria-missing', 'bacteria-missing-retry'),
+                                           ('fungi-second', 'bacteria-taken'),
+                                           ('fungi-second', 'fungi-second-retry')],
+                                 batch_size=3, state='queued', added=added, dispatcher=None)
+    assert results == [True, False, False, True]
+
+    clone = SyncJob(sync_db, 'bacteria-first-retry').fetch()
+    assert clone.original_id == 'bacteria-first'
+    assert clone.state == 'queued'
+    assert clone.added == added
+    assert clone.dispatcher is None
+    assert clone.target_queues == ['jobs:queued']
+    assert sync_db.hget('job:bacteria-taken', 'state') == 'done'
+    assert sync_db.smembers('jobs:state:queued') == {'bacteria-first-retry', 'fungi-second-retry'}
+    assert sync_db.smembers('jobs:dispatcher:worker') == {'bacteria-first', 'fungi-second'}
+    assert SyncJob.job_stats(sync_db)['fungi'] == {'failed': 1, 'queued': 1}
+    assert 'fungi-second-retry' in sync_db.smembers('jobs:taxon:fungi')
+
+    assert SyncJob.clone_many(sync_db, {}) == []
+    with pytest.raises(ValueError):
+        SyncJob.clone_many(sync_db, {'bacteria-first': 'bacteria-other'}, sideload_simple='bob')
+    with pytest.raises(ValueError):
+        SyncJob.clone_many(sync_db, {'bacteria-first': 'bacteria-other'}, state='bob')
+    with pytest.raises(ValueError):
+        SyncJob.clone_many(sync_db, {'bacteria-first': 'bacteria-other'}, nope=1)
+
+
+@pytest.mark.asyncio
+async def test_async_clone_many(async_db):
+    job = AsyncJob(async_db, 'bacteria-source')
+    await job.commit()
+    assert await AsyncJob.clone_many(async_db, {'bacteria-source': 'bacteria-clone'}) == [True]
+    clone = await AsyncJob(async_db, 'bacteria-clone').fetch()
+    assert clone.original_id == 'bacteria-source'
+    assert clone.state == 'created'
+
+
+def test_sync_clone_many_remove_fields(sync_db):
+    job = SyncJob(sync_db, 'bacteria-source')
+    job.state = 'failed'
+    job.sideload_simple = 'NC_003888:1-200'
+    job.commit()
+
+    assert SyncJob.clone_many(sync_db, {job.job_id: 'bacteria-clone'}, state=None, sideload_simple=None,
+                              status='') == [True]
+    assert sync_db.hmget('job:bacteria-clone', 'state', 'sideload_simple', 'status') == [None, None, '']
+    # jobs without a stored state aren't indexed or counted on it
+    assert sync_db.smembers('jobs:state:failed') == {'bacteria-source'}
+    assert SyncJob.job_stats(sync_db) == {'bacteria': {'failed': 1}}
+
+
 def test_async_set_invalid(async_db):
     job = AsyncJob(async_db, 'taxon-fake')
     with pytest.raises(AttributeError):
@@ -263,3 +838,160 @@ def test_sync_set_invalid(sync_db):
     job = SyncJob(sync_db, 'taxon-fake')
     with pytest.raises(AttributeError):
         job.nope = 'foo'
+
+
+class VersionedSyncJob(SyncJob):
+    __slots__ = ()
+    VERSIONED = True
+
+
+class VersionedAsyncJob(AsyncJob):
+    __slots__ = ()
+    VERSIONED = True
+
+
+def test_sync_versioned_commit(sync_db):
+    job = VersionedSyncJob(sync_db, 'bacteria-versioned')
+    assert job.revision is None
+    job.commit()
+    assert sync_db.hget('job:bacteria-versioned', 'revision') == '1'
+    assert 'revision' not in job.to_dict()
+
+    web = VersionedSyncJob(sync_db, 'bacteria-versioned').fetch()
+    dispatcher = VersionedSyncJob(sync_db, 'bacteria-versioned').fetch()
+    assert web.revision == dispatcher.revision == 1
+
+    dispatcher.state = 'queued'
+    dispatcher.commit(if_version=dispatcher.revision)
+    assert dispatcher.revision == 2
+
+    web.email = 'alice@example.org'
+    with pytest.raises(ConflictError):
+        web.commit(if_version=web.revision)
+    assert sync_db.hget('job:bacteria-versioned', 'email') is None
+    assert web._dirty == {'email'}
+
+    # script writes count as well
+    sync_db.lpush('jobs:queued', dispatcher.job_id)
+    VersionedSyncJob.claim(sync_db, 'jobs:queued', 'worker')
+    assert dispatcher.fetch().revision == 3
+
+    # unversioned classes can't do checked commits
+    with pytest.raises(ValueError):
+        SyncJob(sync_db, 'bacteria-versioned').commit(if_version=3)
+
+
+def test_sync_versioned_unversioned_writers(sync_db):
+    VersionedSyncJob(sync_db, 'bacteria-versioned').commit()
+    versioned = VersionedSyncJob(sync_db, 'bacteria-versioned').fetch()
+    assert versioned.revision == 1
+
+    # writers of non-VERSIONED classes count their changes to jobs that have a revision
+    plain = SyncJob(sync_db, 'bacteria-versioned').fetch()
+    plain.status = 'changed by the web frontend'
+    plain.commit()
+    assert sync_db.hget('job:bacteria-versioned', 'revision') == '2'
+    plain.incr_field('seed')
+    assert sync_db.hget('job:bacteria-versioned', 'revision') == '3'
+
+    versioned.status = 'stale'
+    with pytest.raises(ConflictError):
+        versioned.commit(if_version=1)
+    assert sync_db.hget('job:bacteria-versioned', 'status') == 'changed by the web frontend'
+
+    # and don't start counting on jobs without one
+    SyncJob(sync_db, 'bacteria-plain').commit()
+    SyncJob(sync_db, 'bacteria-plain').incr_field('seed')
+    assert sync_db.hget('job:bacteria-plain', 'revision') is None
+
+
+def test_sync_versioned_update(sync_db):
+    job = VersionedSyncJob(sync_db, 'bacteria-versioned')
+    job.commit()
+    other = VersionedSyncJob(sync_db, 'bacteria-versioned')
+    calls = []
+
+    def mutate(obj):
+        calls.append(obj.revision)
+        if len(calls) == 1:
+            # simulate a concurrent write between the fetch and the commit
+            other.status = 'changed elsewhere'
+            other.commit()
+        obj.state = 'done'
+
+    job.update(mutate)
+    assert calls == [1, 2]
+    assert job.revision == 3
+    assert sync_db.hmget('job:bacteria-versioned', 'state', 'status') == ['done', 'changed elsewhere']
+
+    def always_conflict(obj):
+        other.status = 'again'
+        other.commit()
+
+    with pytest.raises(ConflictError):
+        job.update(always_conflict, retries=1)
+
+
+@pytest.mark.asyncio
+async def test_async_versioned_update(async_db):
+    job = VersionedAsyncJob(async_db, 'bacteria-versioned')
+    await job.commit()
+    await job.fetch()
+    await job.commit(if_version=1)
+    assert job.revision == 1
+
+    await async_db.hset('job:bacteria-versioned', 'revision', 5)
+    job.status = 'stale'
+    with pytest.raises(ConflictError):
+        await job.commit(if_version=1)
+
+    def mutate(obj):
+        obj.status = 'fresh'
+
+    await job.update(mutate)
+    assert job.revision == 6
+    assert await async_db.hget('job:bacteria-versioned', 'status') == 'fresh'
+
+
+def test_sync_versioned_clone(sync_db):
+    job = VersionedSyncJob(sync_db, 'bacteria-versioned')
+    job.commit()
+    job.state = 'failed'
+    job.commit()
+    assert VersionedSyncJob.clone_many(sync_db, {job.job_id: 'bacteria-clone'}) == [True]
+    assert VersionedSyncJob(sync_db, 'bacteria-clone').fetch().revision == 1
+
+
+def test_sync_scripts_reloaded(sync_db):
+    # e.g. after a server restart, the scripts need loading again
+    sync_db.script_flush()
+    job = SyncJob(sync_db, 'bacteria-scripts')
+    job.state = 'queued'
+    assert job.commit() > 0
+    assert sync_db.script_exists(_COMMIT_SCRIPT.sha) == [True]
+    assert sync_db.smembers('jobs:state:queued') == {'bacteria-scripts'}
+    assert SyncJob.job_stats(sync_db) == {'bacteria': {'queued': 1}}
+
+    sync_db.script_flush()
+    sync_db.lpush('jobs:queued', job.job_id)
+    claimed = SyncJob.claim(sync_db, 'jobs:queued', 'worker')
+    assert claimed.state == 'running'
+
+    # checked commits can't be re-run, so they load the scripts first
+    sync_db.script_flush()
+    versioned = VersionedSyncJob(sync_db, 'bacteria-scripts').fetch()
+    versioned.status = 'checked'
+    versioned.commit(if_version=versioned.revision)
+    assert sync_db.hget('job:bacteria-scripts', 'status') == 'checked'
+
+
+@pytest.mark.asyncio
+async def test_async_scripts_reloaded(async_db):
+    await async_db.script_flush()
+    job = AsyncJob(async_db, 'bacteria-scripts')
+    job.state = 'queued'
+    await job.commit()
+    await async_db.script_flush()
+    assert (await AsyncJob.commit_many([job], full=True))[0] == 0
+    assert await async_db.smembers('jobs:state:queued') == {'bacteria-scripts'}
+    assert await AsyncJob.job_stats(async_db) == {'bacteria': {'queued': 1}}
@@ -1,6 +1,9 @@
 """Tests for the Notice objects"""
+from datetime import timedelta
+
 import pytest
 
+from antismash_models import utils
 from antismash_models.notice import AsyncNotice, SyncNotice
 
 
@@ -36,9 +39,98 @@ def test_low_res_date(sync_db):
     notice.fetch()
 
 
+def test_sync_expire_partial(sync_db):
+    notice = SyncNotice(sync_db, 'fake', show_until=utils.now() + timedelta(days=1))
+    notice.commit()
+
+    partial = SyncNotice(sync_db, 'fake').fetch(fields=['text'])
+    partial.text = 'changed'
+    partial.commit()
+    assert 0 < sync_db.ttl(notice._key) <= 86400
+
+    partial.show_until = utils.now() + timedelta(days=2)
+    partial.commit()
+    assert 86400 < sync_db.ttl(notice._key) <= 2 * 86400
+
+
+def test_sync_window_partial(sync_db):
+    show_from = utils.now() - timedelta(days=1)
+    show_until = utils.now() + timedelta(days=1)
+    SyncNotice(sync_db, 'fake', show_from=show_from, show_until=show_until).commit()
+
+    partial = SyncNotice(sync_db, 'fake').fetch(fields=['teaser'])
+    partial.teaser = 'changed'
+    partial.commit()
+    assert sync_db.zscore('notices:show_from', 'fake') == utils.to_timestamp(show_from)
+    assert sync_db.zscore('notices:show_until', 'fake') == utils.to_timestamp(show_until)
+    assert [notice.teaser for notice in SyncNotice.active(sync_db)] == ['changed']
+
+    partial.show_from = show_from - timedelta(days=1)
+    partial.commit()
+    assert sync_db.zscore('notices:show_from', 'fake') == utils.to_timestamp(partial.show_from)
+    assert sync_db.zscore('notices:show_until', 'fake') == utils.to_timestamp(show_until)
+
+
 @pytest.mark.asyncio
 async def test_async_expire(async_db):
     notice = AsyncNotice(async_db, 'fake')
     await notice.commit()
     # default expiration is 1 week == 604800 seconds
     assert await async_db.ttl(notice._key) <= 604800
+
+
+def test_sync_commit_many(sync_db):
+    notices = [SyncNotice(sync_db, 'first'), SyncNotice(sync_db, 'second')]
+    SyncNotice.commit_many(notices)
+    assert 0 < sync_db.ttl('notice:first') <= 604800
+    assert 0 < sync_db.ttl('notice:second') <= 604800
+
+
+@pytest.mark.asyncio
+async def test_async_commit_many(async_db):
+    notices = [AsyncNotice(async_db, 'first'), AsyncNotice(async_db, 'second')]
+    await AsyncNotice.commit_many(notices, transaction=True)
+    assert 0 < await async_db.ttl('notice:first') <= 604800
+    assert 0 < await async_db.ttl('notice:second') <= 604800
+
+
+def test_sync_iter_all(sync_db):
+    SyncNotice(sync_db, 'first').commit()
+    SyncNotice(sync_db, 'second', category='warning').commit()
+
+    notices = list(SyncNotice.iter_all(sync_db, category='warning'))
+    assert [notice.notice_id for notice in notices] == ['second']
+
+
+def test_sync_active(sync_db):
+    current = utils.now()
+    SyncNotice(sync_db, 'current', text='now', show_from=current - timedelta(hours=1)).commit()
+    SyncNotice(sync_db, 'future', show_from=current + timedelta(days=1)).commit()
+    SyncNotice(sync_db, 'older', show_from=current - timedelta(days=2)).commit()
+    # expired notices are pruned from the indexes
+    sync_db.zadd('notices:show_from', {'expired': utils.to_timestamp(current - timedelta(days=2))})
+    sync_db.zadd('notices:show_until', {'expired': utils.to_timestamp(current - timedelta(days=1))})
+
+    active = SyncNotice.active(sync_db)
+    assert [notice.notice_id for notice in active] == ['older', 'current']
+    assert active[1].text == 'now'
+    assert sync_db.zscore('notices:show_from', 'expired') is None
+    assert sync_db.zscore('notices:show_until', 'expired') is None
+
+    # committing a fetched notice keeps it indexed
+    active[1].show_from = current + timedelta(hours=1)
+    active[1].commit()
+    assert [notice.notice_id for notice in SyncNotice.active(sync_db)] == ['older']
+
+    active[0].delete()
+    assert SyncNotice.active(sync_db) == []
+    assert sync_db.zscore('notices:show_from', 'older') is None
+
+
+@pytest.mark.asyncio
+async def test_async_active(async_db):
+    await AsyncNotice(async_db, 'current', category='warning').commit()
+
+    active = await AsyncNotice.active(async_db)
+    assert [notice.notice_id for notice in active] == ['current']
+    assert active[0].category == 'warning'
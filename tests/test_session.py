@@ -0,0 +1,104 @@
+from datetime import timedelta
+
+import pytest
+
+from antismash_models import utils
+from antismash_models.control import CONTROL_TIMEOUT, AsyncControl, SyncControl
+from antismash_models.job import AsyncJob, SyncJob
+from antismash_models.notice import SyncNotice
+from antismash_models.session import AsyncSession, SyncSession
+
+
+def test_sync_session(sync_db):
+    job = SyncJob(sync_db, 'bacteria-session')
+    control = SyncControl(sync_db, 'worker', 4)
+    notice = SyncNotice(sync_db, 'maintenance', text='soon',
+                        show_until=utils.now() + timedelta(hours=1))
+
+    with SyncSession(sync_db) as session:
+        session.add(job, control)
+        session.add(notice, job)
+        assert len(session) == 3
+        # nothing is written until the block ends
+        assert not sync_db.exists('job:bacteria-session')
+
+    assert len(session) == 0
+    assert all(not isinstance(res, Exception) for res in session.results)
+    assert session.errors == []
+    assert sync_db.hget('job:bacteria-session', 'state') == 'created'
+    assert sync_db.smembers('jobs:state:created') == {'bacteria-session'}
+    assert -1 < sync_db.ttl('control:worker') <= CONTROL_TIMEOUT
+    assert sync_db.ttl('notice:maintenance') > -1
+    assert job._dirty == set()
+
+    # only changes are written on the next flush
+    job.state = 'queued'
+    session.add(job)
+    session.flush()
+    assert sync_db.hget('job:bacteria-session', 'state') == 'queued'
+
+    with pytest.raises(ValueError):
+        session.add('job')
+
+
+def test_sync_session_single_transaction(sync_db, monkeypatch):
+    # e.g. after a server restart, the scripts need loading again without splitting the transaction
+    sync_db.script_flush()
+    transactions = []
+    pipeline = sync_db.pipeline
+
+    def counting_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe._execute_transaction
+
+        def counting_execute(connection, commands, raise_on_error):
+            transactions.append([command[0][0] for command in commands])
+            return execute(connection, commands, raise_on_error)
+
+        pipe._execute_transaction = counting_execute
+        return pipe
+
+    monkeypatch.setattr(sync_db, 'pipeline', counting_pipeline)
+    with SyncSession(sync_db) as session:
+        session.add(SyncJob(sync_db, 'bacteria-session'), SyncControl(sync_db, 'worker', 4))
+
+    assert session.errors == []
+    assert transactions == [['EVALSHA', 'HSET', 'EVALSHA', 'EXPIRE', 'ZADD']]
+    assert sync_db.smembers('jobs:state:created') == {'bacteria-session'}
+
+
+def test_sync_session_errors(sync_db):
+    sync_db.set('job:bacteria-broken', 'not a hash')
+    broken = SyncJob(sync_db, 'bacteria-broken')
+    control = SyncControl(sync_db, 'worker', 4)
+
+    session = SyncSession(sync_db)
+    session.add(broken, control)
+    results = session.flush()
+    assert isinstance(results[0], Exception)
+    assert session.errors == [(broken, results[0])]
+    assert broken._dirty is None
+    assert sync_db.hget('control:worker', 'max_jobs') == '4'
+
+    assert session.flush() == []
+
+
+def test_sync_session_exception(sync_db):
+    job = SyncJob(sync_db, 'bacteria-session')
+    with pytest.raises(RuntimeError):
+        with SyncSession(sync_db) as session:
+            session.add(job)
+            raise RuntimeError("abort")
+    assert not sync_db.exists('job:bacteria-session')
+    assert session.results is None
+
+
+@pytest.mark.asyncio
+async def test_async_session(async_db):
+    job = AsyncJob(async_db, 'bacteria-session')
+    control = AsyncControl(async_db, 'worker', 4)
+    async with AsyncSession(async_db) as session:
+        session.add(job, control)
+    assert session.errors == []
+    assert await async_db.exists('job:bacteria-session', 'control:worker') == 2
+    assert await async_db.ttl('control:worker') > -1
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from antismash_models.job import AsyncJob
+from antismash_models.watch import KeyWatcher
+
+
+@pytest.fixture
+async def notify_db(async_db):
+    await async_db.config_set('notify-keyspace-events', 'Kghx')
+    yield async_db
+    for watchers in KeyWatcher._shared.get(async_db, {}).values():
+        await watchers.stop()
+
+
+@pytest.fixture
+def started(monkeypatch):
+    """Watchers started during a test"""
+    watchers = []
+    start = KeyWatcher.start
+
+    async def counting_start(self):
+        watchers.append(self)
+        await start(self)
+
+    monkeypatch.setattr(KeyWatcher, 'start', counting_start)
+    return watchers
+
+
+@pytest.mark.asyncio
+async def test_shared_watcher(notify_db):
+    watcher = await KeyWatcher.shared(notify_db, 'job')
+    assert await KeyWatcher.shared(notify_db, 'job') is watcher
+    assert watcher.running
+
+    first = watcher.watch('job:bacteria-one')
+    second = watcher.watch('job:bacteria-one')
+    other = watcher.watch('job:bacteria-two')
+    await notify_db.hset('job:bacteria-one', 'state', 'done')
+    await asyncio.wait_for(first.wait(), 1)
+    await asyncio.wait_for(second.wait(), 1)
+    assert not other.is_set()
+
+    watcher.unwatch('job:bacteria-one', first)
+    watcher.unwatch('job:bacteria-one', second)
+    assert list(watcher._waiters) == ['job:bacteria-two']
+
+    # stopping wakes up everyone still waiting, and a new watcher is started on the next use
+    await watcher.stop()
+    assert other.is_set()
+    assert await KeyWatcher.shared(notify_db, 'job') is not watcher
+
+
+@pytest.mark.asyncio
+async def test_shared_watcher_concurrent(notify_db, started):
+    watchers = await asyncio.gather(*(KeyWatcher.shared(notify_db, 'job') for _ in range(5)))
+    assert all(watcher is watchers[0] for watcher in watchers)
+    assert started == [watchers[0]]
+
+
+@pytest.mark.asyncio
+async def test_wait_for_change(notify_db):
+    job = AsyncJob(notify_db, 'bacteria-wait')
+    await job.commit()
+    assert await job.wait_for_change(0.05) is False
+
+    other = AsyncJob(notify_db, 'bacteria-wait')
+    other.status = 'working'
+
+    async def change():
+        await asyncio.sleep(0.05)
+        await other.commit()
+
+    waiting = asyncio.create_task(job.wait_for_change(1))
+    await change()
+    assert await waiting is True
+    assert job.status == 'working'
+
+
+@pytest.mark.asyncio
+async def test_wait_for_state(notify_db, started):
+    job = AsyncJob(notify_db, 'bacteria-wait')
+    await job.commit()
+    other = AsyncJob(notify_db, 'bacteria-wait')
+
+    async def progress():
+        for state in ('queued', 'running', 'done'):
+            await asyncio.sleep(0.02)
+            other.state = state
+            await other.commit()
+
+    waiters = [asyncio.create_task(AsyncJob(notify_db, job.job_id).wait_for_state({'done', 'failed'}, 1))
+               for _ in range(3)]
+    await progress()
+    assert await asyncio.gather(*waiters) == [True, True, True]
+    # only one subscription is used for all of them
+    assert len(started) == 1
+
+    assert await job.wait_for_state('done', 0.05) is True
+    assert job.state == 'done'
+    assert await job.wait_for_state('failed', 0.05) is False
+
+    with pytest.raises(ValueError):
+        await job.wait_for_state('bob', 1)